@@ -3,11 +3,27 @@ import json
 import time
 import random
 from datetime import datetime, timedelta
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional, Callable
 import openai
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
 import os
+import threading
+import uuid
+import hashlib
+import gzip
+import mmap
+import sys
+import struct
+import math
+import re
+import unicodedata
+import contextvars
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, wait, as_completed, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from openai import OpenAI
+import httpx
 import numpy as np
 import requests
 
@@ -20,10 +36,27 @@ st.set_page_config(
 )
 
 # Configuración de OpenAI
+def create_openai_client(api_key: str) -> OpenAI:
+    """Cliente OpenAI sin reintentos automáticos del SDK
+    
+    Los reintentos los hace `call_with_deadline` dentro del presupuesto de
+    la petición. Con `OPENAI_CASSETTE_MODE=record|replay` las peticiones
+    pasan por el transporte de grabación/reproducción.
+    """
+    extra = {"transport": get_cassette_transport()} if CASSETTE_MODE != "off" else {}
+    return OpenAI(
+        api_key=api_key,
+        max_retries=0,
+        http_client=openai.DefaultHttpxClient(**extra)
+    )
+
 def setup_openai():
     """Configurar la API de OpenAI"""
     # Primero intentar obtener de secrets de Streamlit
     api_key = st.secrets.get("OPENAI_API_KEY", None)
+    if not api_key and CASSETTE_MODE == "replay":
+        # Reproduciendo una grabación no se llega a la API: basta una clave ficticia
+        api_key = "sk-replay"
     
     # Si no está en secrets, pedir al usuario
     if not api_key:
@@ -38,12 +71,12 @@ def setup_openai():
             
             if api_key:
                 st.success("✅ API Key configurada")
-                return OpenAI(api_key=api_key)
+                return create_openai_client(api_key)
             else:
                 st.warning("🔑 Necesitas una API key para continuar")
                 st.stop()
     else:
-        return OpenAI(api_key=api_key)
+        return create_openai_client(api_key)
     
     return None
 
@@ -91,6 +124,54 @@ SPANISH_CITIES = [
 # Normalizar lista (eliminar duplicados y ordenar)
 SPANISH_CITIES = sorted(list(set(SPANISH_CITIES)))
 
+# Variantes del nombre de cada ciudad (cooficiales, históricas, abreviadas).
+# Las formas sin tildes, mayúsculas o guiones no hace falta listarlas.
+CITY_ALIASES = {
+    "San Sebastián": ["Donostia", "Donostia-San Sebastián", "San Sebastián-Donostia", "Donosti"],
+    "A Coruña": ["La Coruña", "Coruña"],
+    "Vitoria-Gasteiz": ["Vitoria", "Gasteiz"],
+    "Palma": ["Palma de Mallorca", "Ciutat de Mallorca"],
+    "Lleida": ["Lérida"],
+    "Girona": ["Gerona"],
+    "Ourense": ["Orense"],
+    "Castellón de la Plana": ["Castellón", "Castelló", "Castelló de la Plana"],
+    "Alicante": ["Alacant"],
+    "Valencia": ["València"],
+    "Elche": ["Elx"],
+    "Bilbao": ["Bilbo"],
+    "Pamplona": ["Iruña", "Iruñea", "Pamplona-Iruña"],
+    "Gijón": ["Xixón"],
+    "Hospitalet de Llobregat": ["L'Hospitalet de Llobregat", "L'Hospitalet"],
+    "Las Palmas de Gran Canaria": ["Las Palmas"],
+    "Santiago de Compostela": ["Santiago"],
+    "Jerez de la Frontera": ["Jerez"],
+    "Calpe": ["Calp"],
+}
+
+def fold_accents(text: str) -> str:
+    """Minúsculas y sin tildes ni diéresis ("Córdoba" -> "cordoba")"""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+def city_lookup_key(name: str) -> str:
+    """Forma normalizada de un nombre: sin tildes, signos ni espacios repetidos"""
+    return " ".join(re.findall(r"[a-z0-9]+", fold_accents(name)))
+
+_CITY_INDEX = {city_lookup_key(city): city for city in SPANISH_CITIES}
+_CITY_INDEX.update({
+    city_lookup_key(variant): canonical
+    for canonical, variants in CITY_ALIASES.items()
+    for variant in [canonical, *variants]
+})
+
+def canonical_city(name: str) -> str:
+    """Nombre canónico de la ciudad ("Donostia" -> "San Sebastián"); si no se conoce, el recibido"""
+    return _CITY_INDEX.get(city_lookup_key(name), name.strip())
+
+def canonical_city_key(name: str) -> str:
+    """Clave de caché única para todas las variantes de una ciudad"""
+    return city_lookup_key(canonical_city(name))
+
 # Base de datos enriquecida de información de viajes (simula RAG)
 TRAVEL_DATABASE = {
     "madrid": {
@@ -182,13 +263,848 @@ TRAVEL_DATABASE = {
     }
 }
 
+class LRUCache:
+    """Caché LRU en memoria, segura entre hilos"""
+    
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: str) -> Any:
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+    
+    def set(self, key: str, value: Any):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+    
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+# Trazas de extremo a extremo (formato OTLP/JSON, una línea por lote de spans)
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_FILE = os.environ.get("TRACE_FILE", "traces.jsonl")
+TRACE_SERVICE_NAME = "planificador-viajes-ia"
+TRACE_MEMORY_SIZE = 200      # Trazas recientes disponibles para la pestaña de metadatos
+
+_CURRENT_SPAN: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    """Convierte un valor Python al AnyValue de OTLP/JSON"""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+class Span:
+    """Intervalo de tiempo con atributos dentro de una traza"""
+    
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = dict(attributes)
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+    
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+    
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+    
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in self.attributes.items()
+                           if v is not None],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1}
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+class _NoopSpan:
+    """Span de las trazas no muestreadas: no registra nada"""
+    trace_id = ""
+    span_id = ""
+    
+    def set_attribute(self, key: str, value: Any):
+        pass
+    
+    def set_attributes(self, **attributes):
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+class Tracer:
+    """Trazas por muestreo para cada etapa del pipeline y cada llamada a OpenAI
+    
+    La decisión de muestreo se toma en el span raíz; en las trazas no
+    muestreadas todos los spans son `NOOP_SPAN`, así que el coste es una
+    consulta a un ContextVar. Al cerrar el span raíz se escribe una línea
+    OTLP/JSON en `TRACE_FILE` con todos los spans de la traza.
+    """
+    
+    def __init__(self, path: str = TRACE_FILE, sample_rate: float = TRACE_SAMPLE_RATE):
+        self.path = path
+        self.sample_rate = sample_rate
+        self._pending: Dict[str, List[Span]] = defaultdict(list)
+        self._recent = LRUCache(TRACE_MEMORY_SIZE)
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def span(self, name: str, root: bool = False, **attributes):
+        """Abre un span hijo del actual; con `root=True` inicia una traza nueva si se muestrea"""
+        parent = _CURRENT_SPAN.get()
+        if root:
+            if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+                token = _CURRENT_SPAN.set(None)
+                try:
+                    yield NOOP_SPAN
+                finally:
+                    _CURRENT_SPAN.reset(token)
+                return
+            span = Span(name, os.urandom(16).hex(), None, attributes)
+        elif parent is None:
+            yield NOOP_SPAN
+            return
+        else:
+            span = Span(name, parent.trace_id, parent.span_id, attributes)
+        
+        with self._activate(span):
+            yield span
+    
+    @contextmanager
+    def attach(self, trace_id: str, parent_id: str, name: str, **attributes):
+        """Abre un span dentro de una traza ya iniciada (p. ej. desde otro rerun)"""
+        if not trace_id:
+            yield NOOP_SPAN
+            return
+        with self._activate(Span(name, trace_id, parent_id, attributes)) as span:
+            yield span
+    
+    @contextmanager
+    def _activate(self, span: Span):
+        token = _CURRENT_SPAN.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _CURRENT_SPAN.reset(token)
+            span.end_ns = time.time_ns()
+            self._finish(span)
+    
+    def _finish(self, span: Span):
+        with self._lock:
+            recent = self._recent.get(span.trace_id) or []
+            self._recent.set(span.trace_id, recent + [span.to_otlp()])
+            # Los spans se escriben juntos al cerrar la raíz; los tardíos, de uno en uno
+            is_late = span.parent_id is not None and span.trace_id not in self._pending and recent
+            self._pending[span.trace_id].append(span)
+            if span.parent_id is None or is_late:
+                self._export(self._pending.pop(span.trace_id))
+    
+    def _export(self, spans: List[Span]):
+        line = {
+            "resourceSpans": [{
+                "resource": {"attributes": [
+                    {"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}
+                ]},
+                "scopeSpans": [{
+                    "scope": {"name": "planificador.tracer"},
+                    "spans": [span.to_otlp() for span in spans]
+                }]
+            }]
+        }
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+        except OSError:
+            pass  # Las trazas nunca deben romper una generación
+    
+    def get_trace(self, trace_id: str) -> List[Dict[str, Any]]:
+        """Spans OTLP de una traza reciente, ordenados por inicio"""
+        if not trace_id:
+            return []
+        with self._lock:
+            spans = list(self._recent.get(trace_id) or [])
+        return sorted(spans, key=lambda span: int(span["startTimeUnixNano"]))
+
+def current_span():
+    """Span activo en este hilo (o NOOP_SPAN si la traza no se muestrea)"""
+    return _CURRENT_SPAN.get() or NOOP_SPAN
+
+def record_usage(span, response):
+    """Anota en el span los tokens consumidos según `response.usage`"""
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        span.set_attributes(**{
+            "tokens.prompt": getattr(usage, "prompt_tokens", None),
+            "tokens.completion": getattr(usage, "completion_tokens", None),
+            "tokens.total": getattr(usage, "total_tokens", None)
+        })
+
+def submit_with_context(executor: ThreadPoolExecutor, fn: Callable, *args):
+    """Envía `fn` al executor conservando el span activo del llamador"""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+@st.cache_resource
+def get_tracer() -> Tracer:
+    """Tracer único del servidor"""
+    return Tracer()
+
+TRACER = get_tracer()
+
+# Presupuesto de tiempo extremo a extremo y límites por etapa (segundos)
+REQUEST_BUDGET = 60.0
+STAGE_TIMEOUTS = {
+    "city_info": 20.0,
+    "embeddings": 8.0,
+    "generation": 45.0
+}
+
+# Hedging de llamadas pequeñas e idempotentes (embedding de la query, info de ciudad)
+HEDGE_IDEMPOTENT_CALLS = True
+HEDGE_MIN_SAMPLES = 20       # Sin este número de muestras no se duplica: el p95 aún no es fiable
+HEDGE_WINDOW = 200           # Latencias recientes usadas para calcular el p95
+
+# Reintentos propios (el cliente no reintenta: el SDK ignora el presupuesto global)
+OPENAI_MAX_ATTEMPTS = 3
+RETRY_BACKOFF = 0.5
+RETRYABLE_ERRORS = (openai.APITimeoutError, openai.APIConnectionError,
+                    openai.RateLimitError, openai.InternalServerError)
+
+class DeadlineExceeded(TimeoutError):
+    """Se agotó el presupuesto de tiempo de la petición"""
+
+class Deadline:
+    """Presupuesto de tiempo extremo a extremo repartido entre las etapas del pipeline"""
+    
+    def __init__(self, budget: float = REQUEST_BUDGET):
+        self.expires_at = time.monotonic() + budget
+    
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+    
+    def timeout_for(self, stage: str) -> float:
+        """Timeout de una etapa: su límite propio, recortado a lo que queda del presupuesto"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"Presupuesto de tiempo agotado antes de '{stage}'")
+        return min(STAGE_TIMEOUTS.get(stage, remaining), remaining)
+
+def stage_timeout(deadline: Optional[Deadline], stage: str) -> float:
+    """Timeout para una etapa, con o sin presupuesto global"""
+    if deadline is None:
+        return STAGE_TIMEOUTS[stage]
+    return deadline.timeout_for(stage)
+
+def stage_deadline(deadline: Optional[Deadline], stage: str) -> Deadline:
+    """Presupuesto propio de una etapa completa (esperas incluidas), recortado al global"""
+    limit = STAGE_TIMEOUTS[stage]
+    return Deadline(limit if deadline is None else min(limit, deadline.remaining()))
+
+def call_with_deadline(fn: Callable[[float], Any], deadline: Optional[Deadline], stage: str) -> Any:
+    """Ejecuta `fn(timeout)` reintentando errores transitorios sin salirse del presupuesto
+    
+    Cada intento recibe como timeout lo que quede para la etapa; si no queda
+    tiempo para la espera entre intentos, se propaga el último error.
+    """
+    for attempt in range(OPENAI_MAX_ATTEMPTS):
+        timeout = stage_timeout(deadline, stage)
+        try:
+            return fn(timeout)
+        except RETRYABLE_ERRORS:
+            backoff = RETRY_BACKOFF * 2 ** attempt
+            if attempt == OPENAI_MAX_ATTEMPTS - 1 or (deadline and deadline.remaining() <= backoff):
+                raise
+            current_span().set_attribute("http.retry_count", attempt + 1)
+            time.sleep(backoff)
+
+class MetricsRegistry:
+    """Contadores y medidores compartidos por todas las sesiones del servidor"""
+    
+    def __init__(self):
+        self._values: Dict[str, float] = defaultdict(float)
+        self._lock = threading.Lock()
+    
+    def incr(self, name: str, amount: float = 1):
+        with self._lock:
+            self._values[name] += amount
+    
+    def set_gauge(self, name: str, value: float):
+        with self._lock:
+            self._values[name] = value
+    
+    def get(self, name: str) -> float:
+        with self._lock:
+            return self._values.get(name, 0)
+    
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(sorted(self._values.items()))
+
+@st.cache_resource
+def get_metrics() -> MetricsRegistry:
+    """Registro único de métricas (sobrevive a los reruns de Streamlit)"""
+    return MetricsRegistry()
+
+class HedgedCaller:
+    """Ejecuta llamadas idempotentes con una petición duplicada de respaldo
+    
+    Si la primera petición no ha respondido cuando se alcanza el p95 observado
+    para ese tipo de llamada, se lanza un duplicado y gana la primera respuesta
+    correcta. Las métricas `hedge.<clave>.*` cuentan cuántas veces se dispara
+    el duplicado y cuántas veces gana.
+    """
+    
+    def __init__(self, metrics: MetricsRegistry, max_workers: int = 16):
+        self.metrics = metrics
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+        self._latencies: Dict[str, deque] = defaultdict(lambda: deque(maxlen=HEDGE_WINDOW))
+        self._lock = threading.Lock()
+    
+    def hedge_delay(self, key: str) -> Optional[float]:
+        """p95 de las latencias recientes de `key`, o None si aún no hay muestras suficientes"""
+        with self._lock:
+            samples = list(self._latencies[key])
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return float(np.percentile(samples, 95))
+    
+    def _timed(self, key: str, fn: Callable[[], Any]) -> Any:
+        start = time.monotonic()
+        result = fn()
+        with self._lock:
+            self._latencies[key].append(time.monotonic() - start)
+        return result
+    
+    def call(self, key: str, fn: Callable[[], Any], timeout: float) -> Any:
+        """Ejecuta `fn` con hedging; lanza DeadlineExceeded si nada responde a tiempo"""
+        deadline = time.monotonic() + timeout
+        self.metrics.incr(f"hedge.{key}.calls")
+        
+        delay = self.hedge_delay(key)
+        primary = submit_with_context(self._executor, self._timed, key, fn)
+        done, _ = wait([primary], timeout=timeout if delay is None else min(delay, timeout))
+        if done:
+            return primary.result()
+        if delay is None:
+            # Mientras se calienta el p95 solo se mide: duplicar con un retraso fijo
+            # dispararía casi siempre en las llamadas lentas (p. ej. city_info con gpt-4o)
+            raise DeadlineExceeded(f"Sin respuesta para '{key}' en {timeout:.1f}s")
+        
+        self.metrics.incr(f"hedge.{key}.fired")
+        current_span().set_attribute("hedge.fired", True)
+        backup = submit_with_context(self._executor, self._timed, key, fn)
+        pending = {primary, backup}
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if future is backup:
+                        self.metrics.incr(f"hedge.{key}.won")
+                        current_span().set_attribute("hedge.won", True)
+                    return future.result()
+                error = future.exception()
+        
+        if error is not None:
+            raise error
+        raise DeadlineExceeded(f"Sin respuesta para '{key}' en {timeout:.1f}s")
+
+@st.cache_resource
+def get_hedger() -> HedgedCaller:
+    """Instancia única del ejecutor de hedging"""
+    return HedgedCaller(get_metrics())
+
+# Grabación y reproducción de las llamadas HTTP a OpenAI
+CASSETTE_MODE = os.environ.get("OPENAI_CASSETTE_MODE", "off")   # off | record | replay
+CASSETTE_PATH = os.environ.get("OPENAI_CASSETTE_PATH", "cassettes/openai.jsonl.gz")
+CASSETTE_SIMULATE_LATENCY = os.environ.get("OPENAI_CASSETTE_LATENCY", "0") == "1"
+CASSETTE_IGNORED_FIELDS = {"user", "metadata"}   # No cambian la respuesta
+# Cabeceras que dejan de ser válidas al re-servir el cuerpo fragmento a fragmento
+CASSETTE_DROPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection"}
+
+def normalize_payload(method: str, path: str, body: bytes) -> str:
+    """Clave de emparejado: método, ruta y cuerpo JSON canónico (claves ordenadas, espacios colapsados)"""
+    try:
+        payload = json.loads(body) if body else None
+    except ValueError:
+        return hashlib.sha256(f"{method} {path} ".encode() + body).hexdigest()
+    
+    def canon(value):
+        if isinstance(value, dict):
+            return {k: canon(v) for k, v in value.items() if k not in CASSETTE_IGNORED_FIELDS}
+        if isinstance(value, list):
+            return [canon(v) for v in value]
+        if isinstance(value, str):
+            return " ".join(value.split())
+        return value
+    
+    canonical = json.dumps(canon(payload), sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(f"{method} {path} {canonical}".encode()).hexdigest()
+
+class CassetteStore:
+    """Grabaciones en JSON Lines comprimido con gzip, una interacción por línea
+    
+    Cada entrada guarda estado, cabeceras, tiempo hasta la respuesta
+    y los fragmentos del cuerpo con su instante de llegada, de modo que las
+    respuestas en streaming se reproducen tal como llegaron. Las peticiones
+    repetidas con la misma clave reciben sus grabaciones en orden.
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._entries: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self._cursor: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries[entry["key"]].append(entry)
+    
+    def __len__(self) -> int:
+        return sum(len(entries) for entries in self._entries.values())
+    
+    def next(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                return None
+            entry = entries[self._cursor[key] % len(entries)]
+            self._cursor[key] += 1
+            return entry
+    
+    def append(self, entry: Dict[str, Any]):
+        with self._lock:
+            self._entries[entry["key"]].append(entry)
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # Cada append añade un miembro gzip; gzip.open los lee como un solo flujo
+            with gzip.open(self.path, "at", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+class _RecordingStream(httpx.SyncByteStream):
+    """Deja pasar el cuerpo de la respuesta anotando cada fragmento y su instante"""
+    
+    def __init__(self, inner, entry: Dict[str, Any], started: float, store: CassetteStore):
+        self._inner = inner
+        self._entry = entry
+        self._started = started
+        self._store = store
+        self._saved = False
+    
+    def __iter__(self):
+        for chunk in self._inner:
+            # latin-1 convierte bytes <-> texto sin pérdidas aunque un fragmento corte un carácter
+            self._entry["chunks"].append([round((time.monotonic() - self._started) * 1000, 1),
+                                          chunk.decode("latin-1")])
+            yield chunk
+    
+    def close(self):
+        self._inner.close()
+        if not self._saved:
+            self._saved = True
+            self._store.append(self._entry)
+
+class _ReplayStream(httpx.SyncByteStream):
+    """Devuelve los fragmentos grabados, opcionalmente con su ritmo original"""
+    
+    def __init__(self, entry: Dict[str, Any], simulate_latency: bool):
+        self._entry = entry
+        self._simulate_latency = simulate_latency
+    
+    def __iter__(self):
+        previous_ms = self._entry["ttfb_ms"]
+        for offset_ms, text in self._entry["chunks"]:
+            if self._simulate_latency:
+                time.sleep(max(0.0, offset_ms - previous_ms) / 1000)
+                previous_ms = offset_ms
+            yield text.encode("latin-1")
+
+class CassetteTransport(httpx.BaseTransport):
+    """Transporte httpx que graba o reproduce las llamadas del cliente OpenAI
+    
+    En modo "record" reenvía a la API real y guarda cada interacción; en
+    "replay" responde desde la grabación emparejando por payload normalizado,
+    sin red. Una petición sin grabación recibe un 404 (que el SDK no
+    reintenta) con la clave que faltaba.
+    """
+    
+    def __init__(self, store: CassetteStore, mode: str = CASSETTE_MODE,
+                 inner: Optional[httpx.BaseTransport] = None,
+                 simulate_latency: bool = CASSETTE_SIMULATE_LATENCY,
+                 metrics: Optional[MetricsRegistry] = None):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Modo de grabación desconocido: {mode}")
+        self.store = store
+        self.mode = mode
+        self.inner = inner if inner is not None else (httpx.HTTPTransport() if mode == "record" else None)
+        self.simulate_latency = simulate_latency
+        self.metrics = metrics
+    
+    def _count(self, name: str):
+        if self.metrics:
+            self.metrics.incr(name)
+    
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        key = normalize_payload(request.method, request.url.path, request.read())
+        if self.mode == "replay":
+            return self._replay(request, key)
+        
+        # Cuerpos sin comprimir: la grabación ya se comprime entera
+        request.headers["accept-encoding"] = "identity"
+        started = time.monotonic()
+        response = self.inner.handle_request(request)
+        # Se conservan retry-after, x-should-retry, etc.: el SDK decide con ellas
+        headers = [(name, value) for name, value in response.headers.multi_items()
+                   if name.lower() not in CASSETTE_DROPPED_HEADERS]
+        entry = {
+            "key": key,
+            "method": request.method,
+            "path": request.url.path,
+            "status": response.status_code,
+            "headers": [[name, value] for name, value in headers if name.lower() != "set-cookie"],
+            "ttfb_ms": round((time.monotonic() - started) * 1000, 1),
+            "recorded_at": datetime.now().isoformat(timespec="seconds"),
+            "chunks": []
+        }
+        self._count("cassette.recorded")
+        return httpx.Response(
+            response.status_code,
+            headers=headers,
+            stream=_RecordingStream(response.stream, entry, started, self.store),
+            extensions=response.extensions
+        )
+    
+    def _replay(self, request: httpx.Request, key: str) -> httpx.Response:
+        entry = self.store.next(key)
+        if entry is None:
+            self._count("cassette.misses")
+            return httpx.Response(404, json={"error": {
+                "message": f"Sin grabación para {request.method} {request.url.path} (clave {key[:12]})",
+                "type": "cassette_miss"
+            }})
+        self._count("cassette.replayed")
+        if self.simulate_latency:
+            time.sleep(entry["ttfb_ms"] / 1000)
+        return httpx.Response(
+            entry["status"],
+            headers=[tuple(header) for header in entry["headers"]],
+            stream=_ReplayStream(entry, self.simulate_latency)
+        )
+    
+    def close(self):
+        if self.inner is not None:
+            self.inner.close()
+
+@st.cache_resource
+def get_cassette_transport() -> CassetteTransport:
+    """Transporte de grabación único: todas las sesiones comparten la misma grabación"""
+    return CassetteTransport(CassetteStore(CASSETTE_PATH), mode=CASSETTE_MODE, metrics=get_metrics())
+
+# Caché de dos niveles: LRU local delante de un almacén clave-valor compartido (Redis)
+CACHE_URL = os.environ.get("CACHE_URL")  # p. ej. redis://cache:6379/0 (sin definir = solo memoria)
+CACHE_NAMESPACE = "planificador"
+CACHE_SCHEMA_VERSION = 2     # Subir al cambiar el formato de lo que se guarda
+CACHE_LOCAL_SIZE = 1024
+CACHE_LOCK_TTL = 30          # Segundos máximos que una réplica reserva un cálculo
+CITY_CACHE_TTL = 30 * 24 * 3600
+EMBEDDING_CACHE_TTL = 30 * 24 * 3600
+ITINERARY_CACHE_TTL = 24 * 3600
+
+class InMemoryKVBackend:
+    """Sustituto local del almacén compartido con el subconjunto de Redis que usamos
+    
+    Sirve para desarrollo y pruebas sin servidor: `get`, `set` con `ex`/`nx`
+    y `delete` se comportan como en redis-py; `delete_if_equals` es el
+    borrado condicional que `RedisKVBackend` hace con un script Lua.
+    """
+    
+    def __init__(self):
+        self._data: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+    
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            return value
+    
+    def set(self, key: str, value: bytes, ex: Optional[float] = None, nx: bool = False) -> Optional[bool]:
+        with self._lock:
+            item = self._data.get(key)
+            if nx and item is not None and (item[1] is None or item[1] > time.monotonic()):
+                return None
+            self._data[key] = (value, time.monotonic() + ex if ex else None)
+            return True
+    
+    def delete(self, key: str) -> int:
+        with self._lock:
+            return 1 if self._data.pop(key, None) is not None else 0
+    
+    def delete_if_equals(self, key: str, value: bytes) -> int:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] != value:
+                return 0
+            del self._data[key]
+            return 1
+
+class RedisKVBackend:
+    """Adaptador de redis-py con la misma interfaz que `InMemoryKVBackend`"""
+    
+    # Borra la clave solo si aún guarda nuestro token (atómico en el servidor)
+    _DELETE_IF_EQUALS = """
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("del", KEYS[1])
+    end
+    return 0
+    """
+    
+    def __init__(self, client):
+        self.client = client
+        self._delete_if_equals = client.register_script(self._DELETE_IF_EQUALS)
+    
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(key)
+    
+    def set(self, key: str, value: bytes, ex: Optional[float] = None, nx: bool = False) -> Optional[bool]:
+        return self.client.set(key, value, ex=int(math.ceil(ex)) if ex else None, nx=nx)
+    
+    def delete(self, key: str) -> int:
+        return self.client.delete(key)
+    
+    def delete_if_equals(self, key: str, value: bytes) -> int:
+        return self._delete_if_equals(keys=[key], args=[value])
+
+def create_cache_backend(url: Optional[str] = CACHE_URL):
+    """Backend compartido según la URL: Redis (o compatible) si se configura, memoria si no"""
+    if not url or url.startswith("memory://"):
+        return InMemoryKVBackend()
+    try:
+        import redis
+    except ImportError as e:
+        raise ImportError("CACHE_URL requiere el paquete 'redis' (pip install redis)") from e
+    return RedisKVBackend(redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5))
+
+def encode_json(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False).encode("utf-8")
+
+def decode_json(payload: bytes) -> Any:
+    return json.loads(payload.decode("utf-8"))
+
+def encode_float32_matrix(vectors) -> bytes:
+    """Serializa una matriz de embeddings como cabecera (filas, dims) + float32 little-endian"""
+    matrix = np.ascontiguousarray(vectors, dtype="<f4")
+    return struct.pack("<II", *matrix.shape) + matrix.tobytes()
+
+def decode_float32_matrix(payload: bytes) -> np.ndarray:
+    rows, dims = struct.unpack_from("<II", payload)
+    return np.frombuffer(payload, dtype="<f4", offset=8).reshape(rows, dims).astype(np.float32)
+
+class TwoTierCache:
+    """Caché de dos niveles compartida por las réplicas
+    
+    Las lecturas van primero al LRU local (objetos ya decodificados) y después
+    al backend compartido (bytes). Las claves llevan espacio de nombres y
+    versión de esquema. `get_or_compute` evita estampidas: un solo hilo por
+    réplica calcula cada clave (los demás esperan su futuro) y, entre réplicas,
+    un cerrojo `SET NX EX` con token propio en el backend hace que las demás
+    esperen al valor publicado.
+    """
+    
+    def __init__(self, backend, metrics: Optional[MetricsRegistry] = None,
+                 local_size: int = CACHE_LOCAL_SIZE):
+        self.backend = backend
+        self.metrics = metrics
+        self.local = LRUCache(local_size)
+        self._inflight: Dict[str, Future] = {}
+        self._inflight_lock = threading.Lock()
+    
+    def key(self, kind: str, ident: str) -> str:
+        return f"{CACHE_NAMESPACE}:v{CACHE_SCHEMA_VERSION}:{kind}:{ident}"
+    
+    def _count(self, name: str):
+        if self.metrics:
+            self.metrics.incr(name)
+    
+    def _backend(self, operation: str, *args, **kwargs):
+        """Llamada al backend compartido; un fallo de red nunca rompe la petición"""
+        try:
+            return getattr(self.backend, operation)(*args, **kwargs)
+        except Exception:
+            self._count("cache.shared.errors")
+            return None
+    
+    def get(self, kind: str, ident: str, decode: Callable[[bytes], Any], record: bool = True) -> Any:
+        """Valor decodificado o None si no está en ningún nivel"""
+        key = self.key(kind, ident)
+        value = self.local.get(key)
+        if value is not None:
+            if record:
+                self._count("cache.local.hits")
+            return value
+        if record:
+            self._count("cache.local.misses")
+        
+        payload = self._backend("get", key)
+        if payload is None:
+            if record:
+                self._count("cache.shared.misses")
+            return None
+        if record:
+            self._count("cache.shared.hits")
+        value = decode(payload)
+        self.local.set(key, value)
+        return value
+    
+    def set(self, kind: str, ident: str, payload: bytes, decode: Callable[[bytes], Any],
+            ttl: Optional[float] = None) -> Any:
+        """Guarda el valor serializado en ambos niveles y devuelve el objeto decodificado"""
+        key = self.key(kind, ident)
+        self._backend("set", key, payload, ex=ttl)
+        value = decode(payload)
+        self.local.set(key, value)
+        return value
+    
+    def get_or_compute(self, kind: str, ident: str, compute: Callable[[], Optional[bytes]],
+                       decode: Callable[[bytes], Any], ttl: Optional[float] = None,
+                       deadline: Optional[Deadline] = None) -> Any:
+        """Devuelve el valor cacheado o lo calcula una sola vez
+        
+        `compute` devuelve el valor serializado, o None si el resultado no
+        debe guardarse (por ejemplo, un fallback); en ese caso se devuelve None.
+        La espera al cálculo de otro hilo u otra réplica no pasa de `deadline`;
+        al vencer, el llamador ejecuta su propio `compute`.
+        """
+        value = self.get(kind, ident, decode)
+        if value is not None:
+            return value
+        
+        key = self.key(kind, ident)
+        with self._inflight_lock:
+            pending = self._inflight.get(key)
+            if pending is None:
+                pending = self._inflight[key] = Future()
+                leader = True
+            else:
+                leader = False
+        
+        if not leader:
+            # Otro hilo de esta réplica ya lo calcula: esperar solo a esa clave
+            try:
+                value = pending.result(timeout=deadline.remaining() if deadline else None)
+            except Exception:
+                value = None
+            if value is not None:
+                return value
+            # El líder no obtuvo un valor cacheable: este llamador calcula el suyo
+            payload = compute()
+            return None if payload is None else self.set(kind, ident, payload, decode, ttl)
+        
+        try:
+            value = self._compute_once(kind, ident, key, compute, decode, ttl, deadline)
+            pending.set_result(value)
+            return value
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+    
+    def _compute_once(self, kind: str, ident: str, key: str, compute: Callable[[], Optional[bytes]],
+                      decode: Callable[[bytes], Any], ttl: Optional[float],
+                      deadline: Optional[Deadline]) -> Any:
+        """Calcula el valor coordinándose con las demás réplicas mediante el cerrojo del backend"""
+        # Pudo publicarse mientras se registraba el cálculo
+        value = self.get(kind, ident, decode, record=False)
+        if value is not None:
+            return value
+        
+        lock_key = f"{key}:lock"
+        token = uuid.uuid4().hex.encode()
+        owns_lock = bool(self._backend("set", lock_key, token, ex=CACHE_LOCK_TTL, nx=True))
+        if not owns_lock:
+            # Otra réplica lo está calculando: esperar a que publique el valor
+            self._count("cache.stampede.waits")
+            give_up_at = time.monotonic() + CACHE_LOCK_TTL
+            if deadline is not None:
+                give_up_at = min(give_up_at, deadline.expires_at)
+            while time.monotonic() < give_up_at:
+                time.sleep(0.1)
+                value = self.get(kind, ident, decode, record=False)
+                if value is not None:
+                    return value
+                if self._backend("get", lock_key) is None:
+                    break
+        try:
+            payload = compute()
+            if payload is None:
+                return None
+            return self.set(kind, ident, payload, decode, ttl)
+        finally:
+            if owns_lock:
+                # Si el cerrojo caducó y otra réplica lo tomó, no se le quita
+                self._backend("delete_if_equals", lock_key, token)
+    
+    def hit_ratios(self) -> Dict[str, float]:
+        """Proporción de aciertos por nivel (el compartido solo cuenta fallos del local)"""
+        ratios = {}
+        for tier in ("local", "shared"):
+            hits = self.metrics.get(f"cache.{tier}.hits") if self.metrics else 0
+            misses = self.metrics.get(f"cache.{tier}.misses") if self.metrics else 0
+            ratios[tier] = hits / (hits + misses) if hits + misses else 0.0
+        return ratios
+
+@st.cache_resource
+def get_shared_cache() -> TwoTierCache:
+    """Caché de dos niveles única por réplica"""
+    return TwoTierCache(create_cache_backend(), metrics=get_metrics())
+
 class CityInfoGenerator:
     """Generador de información de ciudades usando GPT-4"""
     
-    def __init__(self, client):
+    def __init__(self, client, hedger: Optional[HedgedCaller] = None,
+                 on_event: Optional[Callable[[str], None]] = None):
         self.client = client
+        self.hedger = hedger
+        self.on_event = on_event  # Avisos para el usuario (se ejecuta fuera del hilo de Streamlit)
+        self.used_fallback = False
     
-    def generate_city_info(self, city_name: str) -> Dict[str, Any]:
+    def generate_city_info(self, city_name: str, deadline: Optional[Deadline] = None) -> Dict[str, Any]:
         """Genera información detallada de una ciudad española usando GPT-4"""
         
         try:
@@ -220,12 +1136,28 @@ class CityInfoGenerator:
 
 IMPORTANTE: Responde SOLO con el JSON, sin texto adicional. Si la ciudad no existe en España, usa información general española."""
 
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.3,  # Más bajo para información factual
-                max_tokens=1000
-            )
+            timeout = stage_timeout(deadline, "city_info")
+            
+            def request(timeout: float):
+                return self.client.chat.completions.create(
+                    model="gpt-4o",
+                    messages=[{"role": "user", "content": prompt}],
+                    temperature=0.3,  # Más bajo para información factual
+                    max_tokens=1000,
+                    timeout=timeout
+                )
+            
+            with TRACER.span("openai.chat.completions", model="gpt-4o", purpose="city_info",
+                             timeout_s=timeout) as span:
+                # La generación es idempotente: se puede duplicar si se retrasa.
+                # Cada intento va con hedging; los reintentos siguen dentro del presupuesto
+                if self.hedger:
+                    response = call_with_deadline(
+                        lambda timeout: self.hedger.call("city_info", lambda: request(timeout), timeout),
+                        deadline, "city_info")
+                else:
+                    response = call_with_deadline(request, deadline, "city_info")
+                record_usage(span, response)
             
             # Intentar parsear la respuesta como JSON
             import json
@@ -233,9 +1165,12 @@ IMPORTANTE: Responde SOLO con el JSON, sin texto adicional. Si la ciudad no exis
             return city_data
             
         except Exception as e:
-            st.warning(f"Error generando info para {city_name}: {str(e)}")
+            if self.on_event:
+                self.on_event(f"⚠️ Error generando info para {city_name}: {str(e)}. Se usa información genérica")
+            self.used_fallback = True
             # Fallback con información genérica
             return {
+                "informacion_generica": True,
                 "descripcion": f"{city_name} es una hermosa ciudad española con rica historia y cultura.",
                 "atracciones": [
                     "Centro histórico - Pasear por las calles principales",
@@ -259,107 +1194,888 @@ IMPORTANTE: Responde SOLO con el JSON, sin texto adicional. Si la ciudad no exis
                 ]
             }
 
-def get_city_info(city_name: str, client) -> Dict[str, Any]:
-    """Obtiene información de la ciudad, de la base de datos o generándola"""
+# Grafías ya vistas en esta réplica, para contar las generaciones que ahorran los alias
+_SEEN_CITY_SPELLINGS = LRUCache(4096)
+
+def get_city_info(city_name: str, client, deadline: Optional[Deadline] = None,
+                  hedger: Optional[HedgedCaller] = None,
+                  cache: Optional[TwoTierCache] = None,
+                  metrics: Optional[MetricsRegistry] = None,
+                  bundle: Optional["KnowledgeBaseBundle"] = None,
+                  on_event: Optional[Callable[[str], None]] = None,
+                  skipped_spellings: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Obtiene información de la ciudad, de la base de datos, de la caché o generándola
+    
+    Todas las variantes de un nombre ("Donostia", "San Sebastian") se
+    resuelven antes a la ciudad canónica, que es la única que se cachea.
+    `skipped_spellings` son otras grafías de la misma ciudad que el llamador
+    descartó (p. ej. en una comparación) y que cuentan como ahorradas igual
+    que si se hubieran pedido aquí.
+    """
+    
+    with TRACER.span("get_city_info", city=city_name) as span:
+        # Unificar variantes antes de cualquier búsqueda o generación
+        requested = city_name
+        city_name = canonical_city(requested)
+        city_key = city_lookup_key(city_name)
+        # Antes la clave era el nombre en minúsculas: ¿habría sido otra entrada?
+        legacy_key = requested.strip().lower()
+        is_variant = legacy_key != city_name.lower()
+        span.set_attribute("canonical_city", city_name)
+        
+        def record(cache_hit: bool, origin_key: Optional[str] = None):
+            """`origin_key`: grafía (clave antigua) con la que se generó la entrada cacheada"""
+            span.set_attribute("cache_hit", cache_hit)
+            first_time = _SEEN_CITY_SPELLINGS.get(legacy_key) is None
+            _SEEN_CITY_SPELLINGS.set(legacy_key, True)
+            if not metrics:
+                return
+            if not cache_hit:
+                metrics.incr("city.generations")
+            if is_variant:
+                metrics.incr("city.alias.resolved")
+            if cache_hit and first_time and origin_key is not None and origin_key != legacy_key:
+                # La entrada la generó otra grafía: sin el alias, esta habría tenido la suya
+                metrics.incr("city.alias.generations_saved")
+            # Las grafías descartadas solo ahorran algo si la entrada salió de una generación
+            origin = legacy_key if not cache_hit else origin_key
+            for spelling in skipped_spellings or []:
+                skipped_key = spelling.strip().lower()
+                skipped_first = _SEEN_CITY_SPELLINGS.get(skipped_key) is None
+                _SEEN_CITY_SPELLINGS.set(skipped_key, True)
+                if origin is not None and skipped_first and skipped_key != origin:
+                    metrics.incr("city.alias.generations_saved")
+        
+        # Primero intentar encontrar en nuestra base de datos
+        if city_key in TRAVEL_DATABASE:
+            record(True)
+            return TRAVEL_DATABASE[city_key]
+        
+        # Después en el paquete precompilado (solo se decodifica esta ciudad)
+        if bundle is not None:
+            city_info = bundle.get(city_key)
+            if city_info is not None:
+                span.set_attribute("source", "bundle")
+                record(True)
+                return city_info
+        
+        generator = CityInfoGenerator(client, hedger=hedger, on_event=on_event)
+        
+        def notify_generation():
+            if on_event:
+                on_event(f"🤖 Generando información personalizada para {city_name}...")
+        
+        if cache is None:
+            record(False)
+            notify_generation()
+            city_info = generator.generate_city_info(city_name, deadline=deadline)
+            # Agregar a la base de datos temporal para esta sesión
+            TRAVEL_DATABASE[city_key] = city_info
+            return city_info
+        
+        generated = {}
+        # La espera a otra generación en curso cuenta dentro del límite de la etapa
+        city_deadline = stage_deadline(deadline, "city_info")
+        
+        def compute() -> Optional[bytes]:
+            # Si no está en ninguna caché, generar información usando GPT-4
+            notify_generation()
+            generated["info"] = generator.generate_city_info(city_name, deadline=city_deadline)
+            # La información genérica de fallback no se comparte con otras réplicas
+            if generator.used_fallback:
+                return None
+            return encode_json({"registro": generated["info"], "grafia": legacy_key})
+        
+        cached = cache.get_or_compute("city", city_key, compute, decode_json, ttl=CITY_CACHE_TTL,
+                                      deadline=city_deadline)
+        if cached is None:
+            record(False)
+            return generated["info"]
+        record("info" not in generated, origin_key=cached["grafia"])
+        return cached["registro"]
+
+# Almacenamiento del índice de embeddings
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Dimensiones reducidas del modelo (p. ej. 512). Por defecto las 1536 completas: la pérdida
+# de recall al recortar no se ha medido aún con embeddings reales
+EMBEDDING_DIMENSIONS = None
+EMBEDDING_STORAGE = "int8"   # int8 | float16 | float32
+RAG_RERANK = False           # Re-ranking en float32 de los mejores candidatos
+RAG_RERANK_CANDIDATES = 20
+RAG_TOP_K = 5
+RAG_DEFAULT_MODE = "hybrid"  # hybrid | embeddings | bm25
+RAG_MODES = {
+    "hybrid": "Híbrido (BM25 + embeddings)",
+    "embeddings": "Solo embeddings",
+    "bm25": "BM25 local (sin llamadas a la API)"
+}
+RRF_K = 60                   # Constante de Reciprocal Rank Fusion
+
+# Selección del contexto RAG (MMR) y empaquetado con presupuesto de tokens
+RAG_CANDIDATES = 15          # Candidatos que pasan a la selección MMR
+MMR_LAMBDA = 0.7             # 1 = solo relevancia, 0 = solo diversidad
+RAG_FIELD_QUOTA = 2          # Máximo de fragmentos por campo de origen
+RAG_CONTEXT_TOKEN_BUDGET = 100
+DEDUPE_OVERLAP = 0.6         # Solapamiento de términos a partir del cual un fragmento es redundante
+
+class QuantizedEmbeddingIndex:
+    """Índice de embeddings con almacenamiento compacto
+    
+    Los vectores se guardan como una matriz int8 con una escala por fila
+    (o float16/float32) y la similitud se calcula directamente sobre esa
+    matriz. Opcionalmente se conserva la matriz float32 para re-ordenar
+    los mejores candidatos con precisión completa.
+    """
+    
+    def __init__(self, texts: List[str], sources: List[str], embeddings,
+                 storage: str = EMBEDDING_STORAGE, keep_float: bool = RAG_RERANK):
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        
+        self.texts = texts
+        self.sources = sources
+        self.storage = storage
+        self.scales = None
+        if storage == "int8":
+            self.scales = np.maximum(np.abs(matrix).max(axis=1), 1e-12) / 127.0
+            self.codes = np.round(matrix / self.scales[:, None]).astype(np.int8)
+            self.scales = self.scales.astype(np.float32)
+        elif storage == "float16":
+            self.codes = matrix.astype(np.float16)
+        elif storage == "float32":
+            self.codes = matrix
+        else:
+            raise ValueError(f"Almacenamiento de embeddings desconocido: {storage}")
+        self.full_precision = matrix if keep_float and storage != "float32" else None
+    
+    def __len__(self) -> int:
+        return len(self.texts)
+    
+    @property
+    def bytes_per_chunk(self) -> float:
+        """Memoria de los vectores cuantizados (códigos + escala) por fragmento"""
+        total = self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+        return total / max(len(self), 1)
+    
+    def scores(self, query_embedding) -> np.ndarray:
+        """Similitud coseno de la query contra todos los fragmentos"""
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        scores = self.codes @ query
+        if self.scales is not None:
+            scores = scores * self.scales
+        return scores.astype(np.float32)
+    
+    def similarity_matrix(self, indices: List[int]) -> np.ndarray:
+        """Similitud coseno entre los fragmentos indicados (a partir de los vectores cuantizados)"""
+        vectors = self.codes[indices].astype(np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[indices, None]
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors @ vectors.T
+    
+    def search(self, query_embedding, k: int = RAG_TOP_K) -> List[tuple]:
+        """Devuelve pares (score, índice) de los `k` fragmentos más similares"""
+        scores = self.scores(query_embedding)
+        n_candidates = max(k, RAG_RERANK_CANDIDATES) if self.full_precision is not None else k
+        candidates = np.argsort(-scores)[:n_candidates]
+        
+        if self.full_precision is not None:
+            query = np.asarray(query_embedding, dtype=np.float32)
+            query = query / max(float(np.linalg.norm(query)), 1e-12)
+            exact = self.full_precision[candidates] @ query
+            order = np.argsort(-exact)[:k]
+            return [(float(exact[i]), int(candidates[i])) for i in order]
+        
+        return [(float(scores[i]), int(i)) for i in candidates[:k]]
+
+def build_chunks(destination_data: Dict[str, Any]) -> tuple:
+    """Trocea la información del destino en fragmentos `campo: texto` con su campo de origen"""
+    content_texts = []
+    content_sources = []
     
-    # Primero intentar encontrar en nuestra base de datos
-    city_key = city_name.lower()
-    if city_key in TRAVEL_DATABASE:
-        return TRAVEL_DATABASE[city_key]
+    for key, value in destination_data.items():
+        if isinstance(value, list):
+            for item in value:
+                content_texts.append(f"{key}: {item}")
+                content_sources.append(key)
+        elif isinstance(value, str):
+            content_texts.append(f"{key}: {value}")
+            content_sources.append(key)
     
-    # Si no está, generar información usando GPT-4
-    st.info(f"🤖 Generando información personalizada para {city_name}...")
-    generator = CityInfoGenerator(client)
+    return content_texts, content_sources
+
+# Paquete binario de la base de conocimiento (registros + embeddings), mapeado en memoria
+KB_BUNDLE_PATH = os.environ.get("KB_BUNDLE_PATH", "data/kb.bundle")
+KB_MAGIC = b"PVKB"
+KB_FORMAT_VERSION = 1
+# magic, versión, ciudades, fragmentos, dimensiones, modelo, offsets de índice, cadenas y matriz
+_KB_HEADER = struct.Struct("<4sIIII32sQQQ")
+_KB_INDEX_DTYPE = np.dtype([
+    ("key_offset", "<u8"), ("key_length", "<u4"),
+    ("record_offset", "<u8"), ("record_length", "<u4"),
+    ("chunk_start", "<u4"), ("chunk_count", "<u4"),
+    ("digest", "S16")
+])
+
+def chunk_digest(texts: List[str]) -> bytes:
+    """Huella de los fragmentos y del modelo que los embebe"""
+    return hashlib.sha256(
+        f"{EMBEDDING_MODEL}|{EMBEDDING_DIMENSIONS}|".encode() + "\n".join(texts).encode()
+    ).digest()
+
+def _align(offset: int, alignment: int = 64) -> int:
+    return (offset + alignment - 1) // alignment * alignment
+
+def build_kb_bundle(cities: Dict[str, Dict[str, Any]], path: str,
+                    embed: Optional[Callable[[List[str]], Any]] = None) -> Dict[str, int]:
+    """Empaqueta los registros de ciudades (y sus embeddings si hay `embed`) en un fichero
     
-    # Generar y cachear la información
-    city_info = generator.generate_city_info(city_name)
+    Formato v1: cabecera, índice ordenado por clave canónica (`_KB_INDEX_DTYPE`),
+    tabla de cadenas UTF-8 (claves y registros JSON) y matriz float32 de los
+    fragmentos de `build_chunks`, alineada a 64 bytes.
+    """
+    entries = sorted(
+        ((city_lookup_key(canonical_city(name)).encode(), record) for name, record in cities.items()),
+        key=lambda item: item[0]
+    )
+    index = np.zeros(len(entries), dtype=_KB_INDEX_DTYPE)
+    strings = bytearray()
+    blocks = []
+    n_chunks = 0
+    for row, (key, record) in enumerate(entries):
+        texts, _ = build_chunks(record)
+        payload = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode()
+        index[row] = (len(strings), len(key), len(strings) + len(key), len(payload),
+                      n_chunks, len(texts) if embed else 0, chunk_digest(texts)[:16])
+        strings += key + payload
+        if embed and texts:
+            blocks.append(np.asarray(embed(texts), dtype="<f4"))
+            n_chunks += len(texts)
     
-    # Agregar a la base de datos temporal para esta sesión
-    TRAVEL_DATABASE[city_key] = city_info
+    matrix = np.concatenate(blocks) if blocks else np.zeros((0, 0), dtype="<f4")
+    dims = matrix.shape[1] if n_chunks else 0
+    index_offset = _align(_KB_HEADER.size)
+    strings_offset = _align(index_offset + index.nbytes)
+    matrix_offset = _align(strings_offset + len(strings))
+    header = _KB_HEADER.pack(KB_MAGIC, KB_FORMAT_VERSION, len(entries), n_chunks, dims,
+                             EMBEDDING_MODEL.encode() if dims else b"", index_offset,
+                             strings_offset, matrix_offset)
     
-    return city_info
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        for offset, data in ((0, header), (index_offset, index.tobytes()),
+                             (strings_offset, bytes(strings)), (matrix_offset, matrix.tobytes())):
+            f.write(b"\0" * (offset - f.tell()))
+            f.write(data)
+    os.replace(tmp_path, path)  # Los lectores nunca ven un paquete a medias
+    return {"cities": len(entries), "chunks": n_chunks, "dims": dims, "bytes": os.path.getsize(path)}
 
-class EmbeddingSystem:
-    """Sistema de embeddings para RAG real"""
+class KnowledgeBaseBundle:
+    """Lector del paquete de la base de conocimiento
+    
+    El fichero se mapea en memoria de solo lectura: abrirlo no lee los
+    registros y las páginas se comparten entre procesos a través de la caché
+    del sistema. Cada acceso decodifica solo la ciudad pedida.
+    """
+    
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, n_cities, n_chunks, self.dims, model,
+         index_offset, self._strings_offset, matrix_offset) = _KB_HEADER.unpack_from(self._mmap)
+        if magic != KB_MAGIC:
+            raise ValueError(f"{path} no es un paquete de la base de conocimiento")
+        if version != KB_FORMAT_VERSION:
+            raise ValueError(f"Versión de paquete {version} no soportada (se espera {KB_FORMAT_VERSION})")
+        self.path = path
+        self.model = model.rstrip(b"\0").decode()
+        self._index = np.frombuffer(self._mmap, dtype=_KB_INDEX_DTYPE, count=n_cities, offset=index_offset)
+        self._matrix = np.frombuffer(self._mmap, dtype="<f4", count=n_chunks * self.dims,
+                                     offset=matrix_offset).reshape(n_chunks, self.dims)
+    
+    def __len__(self) -> int:
+        return len(self._index)
+    
+    def __contains__(self, city_key: str) -> bool:
+        return self._find(city_key) is not None
+    
+    def _string(self, offset: int, length: int) -> bytes:
+        start = self._strings_offset + int(offset)
+        return self._mmap[start:start + int(length)]
+    
+    def _find(self, city_key: str) -> Optional[int]:
+        """Búsqueda binaria sobre las claves ordenadas (solo decodifica las que visita)"""
+        target = city_key.encode()
+        lo, hi = 0, len(self._index)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key = self._string(self._index[mid]["key_offset"], self._index[mid]["key_length"])
+            if key < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._index):
+            row = self._index[lo]
+            if self._string(row["key_offset"], row["key_length"]) == target:
+                return lo
+        return None
+    
+    def get(self, city_key: str) -> Optional[Dict[str, Any]]:
+        """Registro de la ciudad (clave canónica) o None"""
+        row = self._find(city_key)
+        if row is None:
+            return None
+        entry = self._index[row]
+        return json.loads(self._string(entry["record_offset"], entry["record_length"]))
+    
+    def embeddings_for(self, texts: List[str]) -> Optional[np.ndarray]:
+        """Embeddings precalculados de estos fragmentos, si el paquete los tiene para el modelo actual"""
+        if not self.dims or self.model != EMBEDDING_MODEL or self.dims != (EMBEDDING_DIMENSIONS or 1536):
+            return None
+        rows = np.flatnonzero(self._index["digest"] == chunk_digest(texts)[:16])
+        if not len(rows) or self._index[rows[0]]["chunk_count"] != len(texts):
+            return None
+        start = int(self._index[rows[0]]["chunk_start"])
+        return self._matrix[start:start + len(texts)]
+
+@st.cache_resource
+def get_kb_bundle() -> Optional[KnowledgeBaseBundle]:
+    """Paquete de la base de conocimiento compartido por las sesiones (None si no se ha construido)"""
+    if not os.path.exists(KB_BUNDLE_PATH):
+        return None
+    return KnowledgeBaseBundle(KB_BUNDLE_PATH)
+
+def build_bundle_cli(argv: List[str]):
+    """`python app.py --build-bundle [salida] [--source ciudades.json] [--embed]`"""
+    args = argv[argv.index("--build-bundle") + 1:]
+    output = args[0] if args and not args[0].startswith("--") else KB_BUNDLE_PATH
+    cities = TRAVEL_DATABASE
+    if "--source" in args:
+        with open(args[args.index("--source") + 1], encoding="utf-8") as f:
+            cities = json.load(f)
+    embed = None
+    if "--embed" in args:
+        client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+        extra = {"dimensions": EMBEDDING_DIMENSIONS} if EMBEDDING_DIMENSIONS else {}
+        
+        def embed(texts: List[str]):
+            response = client.embeddings.create(input=texts, model=EMBEDDING_MODEL, **extra)
+            return [data.embedding for data in response.data]
+    
+    start = time.perf_counter()
+    stats = build_kb_bundle(cities, output, embed=embed)
+    print(f"{output}: {stats['cities']} ciudades, {stats['chunks']} fragmentos x {stats['dims']} dims, "
+          f"{stats['bytes'] / 1024:.0f} KiB en {time.perf_counter() - start:.1f}s")
+
+# Palabras vacías en español (ya sin tildes) que no aportan relevancia
+SPANISH_STOPWORDS = {
+    "a", "al", "algo", "algunas", "algunos", "ante", "con", "como", "cual", "cuando",
+    "de", "del", "desde", "donde", "durante", "e", "el", "ella", "ellas", "ellos",
+    "en", "entre", "era", "es", "esa", "esas", "ese", "eso", "esos", "esta", "estas",
+    "este", "esto", "estos", "fue", "ha", "hay", "la", "las", "le", "les", "lo", "los",
+    "mas", "me", "mi", "muy", "ni", "no", "o", "os", "para", "pero", "por", "que",
+    "se", "segun", "ser", "si", "sin", "sobre", "son", "su", "sus", "tambien", "te",
+    "tiene", "todo", "todos", "tu", "u", "un", "una", "unas", "uno", "unos", "y", "ya"
+}
+
+def tokenize_es(text: str) -> List[str]:
+    """Tokeniza texto en español: pliega tildes, quita palabras vacías y plurales simples
+    
+    Se quita una "s" final y después una "e" final, de modo que singular y
+    plural coinciden ("calle"/"calles" -> "call", "ciudades" -> "ciudad").
+    """
+    tokens = []
+    for token in re.findall(r"[a-z0-9]+", fold_accents(text)):
+        if token in SPANISH_STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith("s"):
+            token = token[:-1]
+        if len(token) > 3 and token.endswith("e"):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+class BM25Index:
+    """Índice léxico BM25 en memoria sobre los fragmentos del destino
+    
+    No necesita llamadas a la API, así que sirve como fallback offline,
+    como modo rápido y como segunda señal en la recuperación híbrida.
+    """
+    
+    def __init__(self, texts: List[str], sources: List[str], k1: float = 1.5, b: float = 0.75):
+        self.texts = texts
+        self.sources = sources
+        self.k1 = k1
+        self.b = b
+        self._term_freqs = []
+        self._doc_lengths = np.zeros(len(texts), dtype=np.float32)
+        doc_freqs: Dict[str, int] = defaultdict(int)
+        
+        for i, text in enumerate(texts):
+            tokens = tokenize_es(text)
+            freqs: Dict[str, int] = defaultdict(int)
+            for token in tokens:
+                freqs[token] += 1
+            self._term_freqs.append(freqs)
+            self._doc_lengths[i] = len(tokens)
+            for token in freqs:
+                doc_freqs[token] += 1
+        
+        n_docs = len(texts)
+        self._avg_length = float(self._doc_lengths.mean()) if n_docs else 0.0
+        self._idf = {
+            token: math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            for token, df in doc_freqs.items()
+        }
+    
+    def scores(self, query: str) -> np.ndarray:
+        """Puntuación BM25 de la query contra todos los fragmentos"""
+        scores = np.zeros(len(self.texts), dtype=np.float32)
+        norms = self.k1 * (1 - self.b + self.b * self._doc_lengths / max(self._avg_length, 1e-9))
+        for token in set(tokenize_es(query)):
+            idf = self._idf.get(token)
+            if idf is None:
+                continue
+            for i, freqs in enumerate(self._term_freqs):
+                tf = freqs.get(token)
+                if tf:
+                    scores[i] += idf * tf * (self.k1 + 1) / (tf + norms[i])
+        return scores
+    
+    def search(self, query: str, k: int = RAG_TOP_K) -> List[tuple]:
+        """Devuelve pares (score, índice) de los `k` fragmentos más relevantes"""
+        scores = self.scores(query)
+        # Orden estable: con empates se respeta el orden original de los fragmentos
+        order = np.argsort(-scores, kind="stable")[:k]
+        return [(float(scores[i]), int(i)) for i in order]
+
+def reciprocal_rank_fusion(rankings: List[List[int]], k: int = RRF_K) -> List[tuple]:
+    """Fusiona varios rankings de índices con Reciprocal Rank Fusion; devuelve pares (score, índice)"""
+    fused: Dict[int, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, idx in enumerate(ranking):
+            fused[idx] += 1.0 / (k + rank + 1)
+    return sorted(((score, idx) for idx, score in fused.items()), reverse=True)
+
+def estimate_tokens(text: str) -> int:
+    """Estimación rápida de tokens (~4 caracteres por token en español)"""
+    return math.ceil(len(text) / 4)
+
+def term_overlap(a: set, b: set) -> float:
+    """Fracción de términos del conjunto menor que aparecen en el otro"""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+def mmr_select(candidates: List[int], relevance: np.ndarray, similarity: np.ndarray,
+               sources: List[str], k: int = RAG_TOP_K, lambda_: float = MMR_LAMBDA,
+               field_quota: int = RAG_FIELD_QUOTA) -> List[int]:
+    """Maximal Marginal Relevance con cupo por campo de origen
+    
+    `relevance` y `similarity` están alineados con `candidates` (posiciones,
+    no índices de fragmento). Devuelve los índices elegidos en orden.
+    """
+    selected: List[int] = []
+    per_field: Dict[str, int] = defaultdict(int)
+    remaining = list(range(len(candidates)))
+    
+    while remaining and len(selected) < k:
+        best, best_score = None, -math.inf
+        for pos in remaining:
+            if per_field[sources[candidates[pos]]] >= field_quota:
+                continue
+            redundancy = max(similarity[pos, s] for s in selected) if selected else 0.0
+            score = lambda_ * relevance[pos] - (1 - lambda_) * redundancy
+            if score > best_score:
+                best, best_score = pos, score
+        if best is None:
+            break
+        selected.append(best)
+        remaining.remove(best)
+        per_field[sources[candidates[best]]] += 1
+    
+    return [candidates[pos] for pos in selected]
+
+def pack_context(chunks: List[tuple], token_budget: int = RAG_CONTEXT_TOKEN_BUDGET) -> List[str]:
+    """Empaqueta fragmentos (campo, texto) por campo, sin redundancias y dentro del presupuesto
+    
+    Los fragmentos de un mismo campo se agrupan en una sola línea para no
+    repetir el prefijo, y se descartan los que solapan con otro ya incluido.
+    """
+    groups: Dict[str, List[str]] = {}
+    packed_terms: List[set] = []
+    used_tokens = 0
+    
+    for source, text in chunks:
+        item = text[len(source) + 2:] if text.startswith(f"{source}: ") else text
+        terms = set(tokenize_es(item))
+        if any(term_overlap(terms, seen) >= DEDUPE_OVERLAP for seen in packed_terms):
+            continue
+        cost = estimate_tokens(item) + (estimate_tokens(f"{source}: ") if source not in groups else 1)
+        if used_tokens + cost > token_budget and groups:
+            continue
+        groups.setdefault(source, []).append(item)
+        packed_terms.append(terms)
+        used_tokens += cost
+    
+    return [f"{source}: {'; '.join(items)}" for source, items in groups.items()]
+
+def select_context(ranking: List[tuple], texts: List[str], sources: List[str],
+                   index: Optional[QuantizedEmbeddingIndex] = None) -> List[str]:
+    """Del ranking de candidatos al contexto final: MMR con cupo por campo y empaquetado"""
+    candidates = [idx for _, idx in ranking]
+    scores = np.array([score for score, _ in ranking], dtype=np.float32)
+    relevance = scores / scores.max() if len(scores) and scores.max() > 0 else np.zeros(len(scores))
+    
+    # Redundancia entre candidatos: coseno si hay embeddings, solapamiento léxico si no
+    if index is not None:
+        similarity = index.similarity_matrix(candidates)
+    else:
+        term_sets = [set(tokenize_es(texts[idx])) for idx in candidates]
+        similarity = np.array([[term_overlap(a, b) for b in term_sets] for a in term_sets])
+    
+    selected = mmr_select(candidates, relevance, similarity, sources)
+    context = pack_context([(sources[idx], texts[idx]) for idx in selected])
+    current_span().set_attributes(candidate_count=len(candidates), selected_count=len(selected),
+                                  context_tokens=sum(estimate_tokens(line) for line in context))
+    return context
+
+# Micro-batching de embeddings entre sesiones
+EMBEDDING_BATCHING = True
+EMBEDDING_BATCH_WINDOW_MS = float(os.environ.get("EMBEDDING_BATCH_WINDOW_MS", "5"))
+EMBEDDING_BATCH_MAX_INPUTS = 256   # La API admite hasta 2048 entradas por petición
+EMBEDDING_HEDGE_MAX_INPUTS = 8     # Solo los lotes de consultas (pequeños) se duplican
+
+class _EmbeddingBatch:
+    """Entradas acumuladas para una misma credencial durante la ventana"""
     
     def __init__(self, client):
         self.client = client
-        
-    def create_embeddings(self, texts):
-        """Crear embeddings para textos usando OpenAI"""
+        self.texts: List[str] = []
+        self.waiters: List[tuple] = []   # (future, inicio, cantidad, encolado en)
+        self.timeout = 0.0
+        self.hedge = False   # True solo si todos los llamadores admiten hedging
+        self.closed = threading.Event()
+
+class EmbeddingBatcher:
+    """Agrupa las peticiones de embeddings de todas las sesiones en una sola
+    
+    Cada llamada se añade al lote abierto de su credencial; el lote se envía
+    al cumplirse `window_ms` desde la primera entrada o al llegar a
+    `max_inputs`, y cada llamador recibe solo sus vectores. Las métricas
+    `embeddings.batch.*` cuentan peticiones, entradas, llamadores y la
+    espera añadida por la ventana.
+    """
+    
+    def __init__(self, metrics: Optional[MetricsRegistry] = None, hedger: Optional[HedgedCaller] = None,
+                 window_ms: float = EMBEDDING_BATCH_WINDOW_MS, max_inputs: int = EMBEDDING_BATCH_MAX_INPUTS,
+                 max_workers: int = 8):
+        self.metrics = metrics
+        self.hedger = hedger
+        self.window = window_ms / 1000.0
+        self.max_inputs = max_inputs
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="embed-batch")
+        self._open: Dict[tuple, _EmbeddingBatch] = {}
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _batch_key(client) -> tuple:
+        # Solo se mezclan entradas que van con la misma API key y endpoint
+        api_key = getattr(client, "api_key", None)
+        return (api_key, str(getattr(client, "base_url", ""))) if api_key else (id(client),)
+    
+    def submit(self, client, texts: List[str], timeout: float, hedge: bool = False) -> Future:
+        """Añade `texts` al lote abierto y devuelve un futuro con sus embeddings"""
+        future = Future()
+        key = self._batch_key(client)
+        with self._lock:
+            batch = self._open.get(key)
+            if batch is not None and len(batch.texts) + len(texts) > self.max_inputs:
+                # No cabe: el lote actual sale ya y se abre otro
+                del self._open[key]
+                batch.closed.set()
+                batch = None
+            if batch is None:
+                batch = _EmbeddingBatch(client)
+                self._open[key] = batch
+                submit_with_context(self._executor, self._flush_after_window, key, batch)
+            batch.hedge = hedge and (batch.hedge or not batch.waiters)
+            batch.waiters.append((future, len(batch.texts), len(texts), time.monotonic()))
+            batch.texts.extend(texts)
+            batch.timeout = max(batch.timeout, timeout)
+            if len(batch.texts) >= self.max_inputs:
+                del self._open[key]
+                batch.closed.set()
+        return future
+    
+    def embed(self, client, texts: List[str], timeout: float, hedge: bool = False) -> List[List[float]]:
+        """Versión bloqueante de `submit`"""
         try:
-            response = self.client.embeddings.create(
-                input=texts,
-                model="text-embedding-3-small"
+            return self.submit(client, texts, timeout, hedge=hedge).result(timeout=timeout)
+        except FutureTimeoutError:
+            raise DeadlineExceeded(f"Sin embeddings en {timeout:.1f}s") from None
+    
+    def _count(self, name: str, value: float = 1):
+        if self.metrics:
+            self.metrics.incr(name, value)
+    
+    def _flush_after_window(self, key: tuple, batch: _EmbeddingBatch):
+        batch.closed.wait(self.window)
+        with self._lock:
+            if self._open.get(key) is batch:
+                del self._open[key]
+        
+        sent_at = time.monotonic()
+        extra = {"dimensions": EMBEDDING_DIMENSIONS} if EMBEDDING_DIMENSIONS else {}
+        
+        def request(timeout: float):
+            return batch.client.embeddings.create(
+                input=batch.texts,
+                model=EMBEDDING_MODEL,
+                timeout=timeout,
+                **extra
             )
-            return [data.embedding for data in response.data]
+        
+        try:
+            with TRACER.span("openai.embeddings.batch", model=EMBEDDING_MODEL,
+                             input_count=len(batch.texts), callers=len(batch.waiters),
+                             timeout_s=batch.timeout) as span:
+                # El lote no puede durar más que el plazo más largo de sus llamadores. Un lote
+                # con contenido no se duplica ni cuenta para el p95 de las consultas
+                deadline = Deadline(batch.timeout)
+                if batch.hedge and self.hedger and len(batch.texts) <= EMBEDDING_HEDGE_MAX_INPUTS:
+                    response = call_with_deadline(
+                        lambda timeout: self.hedger.call("query_embedding", lambda: request(timeout), timeout),
+                        deadline, "embeddings")
+                else:
+                    response = call_with_deadline(request, deadline, "embeddings")
+                record_usage(span, response)
+            vectors = [data.embedding for data in sorted(response.data, key=lambda d: d.index)]
+            for future, start, count, _ in batch.waiters:
+                future.set_result(vectors[start:start + count])
         except Exception as e:
-            st.error(f"Error creando embeddings: {str(e)}")
-            return None
+            for future, *_ in batch.waiters:
+                future.set_exception(e)
+        
+        self._count("embeddings.batch.requests")
+        self._count("embeddings.batch.inputs", len(batch.texts))
+        self._count("embeddings.batch.callers", len(batch.waiters))
+        self._count("embeddings.batch.wait_ms", sum((sent_at - queued) * 1000 for *_, queued in batch.waiters))
+
+@st.cache_resource
+def get_embedding_batcher() -> EmbeddingBatcher:
+    """Micro-batcher único compartido por todas las sesiones"""
+    return EmbeddingBatcher(get_metrics(), hedger=get_hedger() if HEDGE_IDEMPOTENT_CALLS else None)
+
+class EmbeddingSystem:
+    """Sistema de embeddings para RAG real"""
+    
+    def __init__(self, client, hedger: Optional[HedgedCaller] = None,
+                 cache: Optional[TwoTierCache] = None, metrics: Optional[MetricsRegistry] = None,
+                 batcher: Optional[EmbeddingBatcher] = None, bundle: Optional[KnowledgeBaseBundle] = None,
+                 on_event: Optional[Callable[[str], None]] = None):
+        self.client = client
+        self.hedger = hedger
+        self.cache = cache
+        self.metrics = metrics
+        self.batcher = batcher
+        self.bundle = bundle
+        self.on_event = on_event
     
-    def semantic_search(self, query, destination_data):
-        """Búsqueda semántica en la información del destino"""
+    def _notify(self, message: str):
+        if self.on_event:
+            self.on_event(message)
+        
+    def create_embeddings(self, texts, deadline: Optional[Deadline] = None, hedge: bool = False):
+        """Crear embeddings para textos usando OpenAI"""
         try:
-            # Crear embedding de la query
-            query_embedding = self.create_embeddings([query])[0]
-            
-            # Crear embeddings del contenido
-            content_texts = []
-            content_sources = []
-            
-            for key, value in destination_data.items():
-                if isinstance(value, list):
-                    for item in value:
-                        content_texts.append(f"{key}: {item}")
-                        content_sources.append(key)
-                elif isinstance(value, str):
-                    content_texts.append(f"{key}: {value}")
-                    content_sources.append(key)
+            timeout = stage_timeout(deadline, "embeddings")
             
-            if not content_texts:
-                return []
+            if self.batcher:
+                # La petición real la hace el micro-batcher junto con las de otras sesiones
+                with TRACER.span("openai.embeddings", model=EMBEDDING_MODEL, input_count=len(texts),
+                                 batched=True, timeout_s=timeout):
+                    return self.batcher.embed(self.client, texts, timeout, hedge=hedge)
             
-            content_embeddings = self.create_embeddings(content_texts)
+            extra = {"dimensions": EMBEDDING_DIMENSIONS} if EMBEDDING_DIMENSIONS else {}
             
-            if not content_embeddings:
-                return content_texts[:3]  # Fallback
-            
-            # Calcular similitudes
-            similarities = []
-            for i, content_emb in enumerate(content_embeddings):
-                similarity = np.dot(query_embedding, content_emb)
-                similarities.append((similarity, content_texts[i], content_sources[i]))
-            
-            # Ordenar por similitud y devolver los más relevantes
-            similarities.sort(reverse=True)
-            return [item[1] for item in similarities[:5]]
+            def request(timeout: float):
+                return self.client.embeddings.create(
+                    input=texts,
+                    model=EMBEDDING_MODEL,
+                    timeout=timeout,
+                    **extra
+                )
             
+            with TRACER.span("openai.embeddings", model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS,
+                             input_count=len(texts), timeout_s=timeout) as span:
+                if hedge and self.hedger:
+                    response = call_with_deadline(
+                        lambda timeout: self.hedger.call("query_embedding", lambda: request(timeout), timeout),
+                        deadline, "embeddings")
+                else:
+                    response = call_with_deadline(request, deadline, "embeddings")
+                record_usage(span, response)
+            return [data.embedding for data in response.data]
         except Exception as e:
-            st.warning(f"Búsqueda semántica falló, usando fallback: {str(e)}")
-            # Fallback a búsqueda simple
-            return [str(v) for v in list(destination_data.values())[:3] if isinstance(v, str)]
+            self._notify(f"⚠️ Error creando embeddings: {str(e)}")
+            return None
+    
+    def get_index(self, texts: List[str], sources: List[str],
+                  deadline: Optional[Deadline] = None) -> Optional[QuantizedEmbeddingIndex]:
+        """Índice cuantizado de los fragmentos, reutilizado entre búsquedas si hay caché
+        
+        El nivel compartido guarda los embeddings en float32; cada réplica
+        construye y conserva en su LRU local el índice cuantizado. Las
+        ciudades del paquete precompilado traen ya sus embeddings.
+        """
+        if self.bundle is not None:
+            bundled = self.bundle.embeddings_for(texts)
+            if bundled is not None:
+                current_span().set_attribute("index.source", "bundle")
+                if self.metrics:
+                    self.metrics.incr("rag.index.bundle")
+                # Copia de las filas de esta ciudad: el mapa en memoria es de solo lectura
+                return QuantizedEmbeddingIndex(texts, sources, np.array(bundled))
+        
+        if self.cache is None:
+            content_embeddings = self.create_embeddings(texts, deadline=deadline)
+            return QuantizedEmbeddingIndex(texts, sources, content_embeddings) if content_embeddings else None
+        
+        key = chunk_digest(texts).hex()
+        computed = {}
+        embeddings_deadline = stage_deadline(deadline, "embeddings")
+        
+        def compute() -> Optional[bytes]:
+            content_embeddings = self.create_embeddings(texts, deadline=embeddings_deadline)
+            computed["miss"] = True
+            return encode_float32_matrix(content_embeddings) if content_embeddings else None
+        
+        def decode(payload: bytes) -> QuantizedEmbeddingIndex:
+            return QuantizedEmbeddingIndex(texts, sources, decode_float32_matrix(payload))
+        
+        index = self.cache.get_or_compute("embeddings", key, compute, decode, ttl=EMBEDDING_CACHE_TTL,
+                                          deadline=embeddings_deadline)
+        current_span().set_attribute("index.cache_hit", "miss" not in computed)
+        if self.metrics:
+            self.metrics.incr("rag.index.misses" if "miss" in computed else "rag.index.hits")
+            if index is not None:
+                self.metrics.set_gauge("rag.index.bytes_per_chunk", index.bytes_per_chunk)
+        return index
+    
+    def semantic_search(self, query, destination_data, deadline: Optional[Deadline] = None,
+                        mode: str = RAG_DEFAULT_MODE):
+        """Búsqueda semántica en la información del destino
+        
+        `mode` elige la recuperación: "embeddings" (vectorial), "bm25" (léxica
+        local, sin API) o "hybrid" (ambas fusionadas con RRF). Si los
+        embeddings fallan se recurre a BM25.
+        """
+        # Trocear el contenido del destino
+        content_texts, content_sources = build_chunks(destination_data)
+        
+        if not content_texts:
+            return []
+        
+        current_span().set_attribute("chunk_count", len(content_texts))
+        lexical_index = BM25Index(content_texts, content_sources)
+        index = None
+        if mode == "bm25":
+            ranking = lexical_index.search(query, k=RAG_CANDIDATES)
+        else:
+            try:
+                if self.batcher:
+                    # La query entra en el lote antes que el contenido: si el índice no
+                    # está en caché, ambos viajan en la misma petición
+                    timeout = stage_timeout(deadline, "embeddings")
+                    pending_query = self.batcher.submit(self.client, [query], timeout, hedge=True)
+                    index = self.get_index(content_texts, content_sources, deadline=deadline)
+                    query_embedding = pending_query.result(timeout=timeout)[0]
+                else:
+                    # Crear embedding de la query (llamada pequeña: se permite hedging)
+                    query_embeddings = self.create_embeddings([query], deadline=deadline, hedge=True)
+                    if not query_embeddings:
+                        raise RuntimeError("no hay embedding de la consulta")
+                    query_embedding = query_embeddings[0]
+                    index = self.get_index(content_texts, content_sources, deadline=deadline)
+                
+                if index is None:
+                    raise RuntimeError("no hay embeddings del contenido")
+                
+                # Similitud sobre la matriz cuantizada
+                if mode == "embeddings":
+                    ranking = index.search(query_embedding, k=RAG_CANDIDATES)
+                else:
+                    # Híbrido: fusionar el ranking vectorial con el léxico
+                    dense_ranking = [i for _, i in index.search(query_embedding, k=len(index))]
+                    lexical_ranking = [i for _, i in lexical_index.search(query, k=len(content_texts))]
+                    ranking = reciprocal_rank_fusion([dense_ranking, lexical_ranking])[:RAG_CANDIDATES]
+                
+            except Exception as e:
+                self._notify(f"⚠️ Búsqueda semántica falló, usando BM25 local: {str(e)}")
+                current_span().set_attribute("fallback", "bm25")
+                if self.metrics:
+                    self.metrics.incr("rag.fallback.bm25")
+                index = None
+                ranking = lexical_index.search(query, k=RAG_CANDIDATES)
+        
+        # Contexto final sin redundancias y dentro del presupuesto de tokens
+        return select_context(ranking, content_texts, content_sources, index)
 
 class TravelPlannerLLM:
     """LLM real especializado en planificación de viajes usando OpenAI"""
     
-    def __init__(self, client):
+    def __init__(self, client, hedger: Optional[HedgedCaller] = None,
+                 cache: Optional[TwoTierCache] = None, metrics: Optional[MetricsRegistry] = None,
+                 batcher: Optional[EmbeddingBatcher] = None, bundle: Optional[KnowledgeBaseBundle] = None,
+                 model: str = "gpt-4o", on_event: Optional[Callable[[str], None]] = None):
         self.client = client
-        self.model = "gpt-4o"  # Usar GPT-4o para mejor rendimiento
-        self.embedding_system = EmbeddingSystem(client)
-        
-    def generate_itinerary(self, preferences: TravelPreferences, rag_data: Dict) -> str:
-        """Genera itinerario usando GPT-4 con técnicas avanzadas de prompting"""
+        self.model = model  # GPT-4o por defecto para mejor rendimiento
+        self.on_event = on_event
+        self.used_fallback = False
+        self.embedding_system = EmbeddingSystem(client, hedger=hedger, cache=cache,
+                                                metrics=metrics, batcher=batcher, bundle=bundle,
+                                                on_event=on_event)
         
+    def generate_itinerary(self, preferences: TravelPreferences, rag_data: Dict,
+                           on_token: Optional[Callable[[str], None]] = None,
+                           deadline: Optional[Deadline] = None,
+                           rag_mode: str = RAG_DEFAULT_MODE) -> str:
+        """Genera itinerario usando GPT-4 con técnicas avanzadas de prompting
+
+        Si se indica `on_token`, la respuesta se pide en streaming y cada
+        fragmento recibido se entrega al callback según llega. Con `deadline`,
+        cada llamada recibe como timeout lo que quede del presupuesto global.
+        """
+
         try:
             # Paso 1: Búsqueda semántica RAG
-            relevant_info = self._perform_rag_search(preferences, rag_data)
-            
+            relevant_info = self._perform_rag_search(preferences, rag_data, deadline, rag_mode)
+
             # Paso 2: Construcción del prompt avanzado
             system_prompt = self._build_system_prompt()
             user_prompt = self._build_user_prompt(preferences, relevant_info)
-            
+
             # Paso 3: Llamada a GPT-4 con parámetros optimizados
-            response = self.client.chat.completions.create(
+            return self._complete(system_prompt, user_prompt, on_token, deadline)
+            
+        except Exception as e:
+            if self.on_event:
+                self.on_event(f"❌ Error generando itinerario: {str(e)}. Se usa la versión básica")
+            self.used_fallback = True
+            return self._generate_fallback_itinerary(preferences, rag_data)
+    
+    def _complete(self, system_prompt: str, user_prompt: str,
+                  on_token: Optional[Callable[[str], None]], deadline: Optional[Deadline]) -> str:
+        """Llamada a la API de chat, con streaming si hay callback"""
+        stream = on_token is not None
+        start = time.monotonic()
+        with TRACER.span("openai.chat.completions", model=self.model, purpose="itinerary",
+                         stream=stream, max_tokens=3000) as span:
+            # Solo se reintenta la apertura: un stream ya empezado no se repite
+            response = call_with_deadline(lambda timeout: self.client.chat.completions.create(
                 model=self.model,
                 messages=[
                     {"role": "system", "content": system_prompt},
@@ -369,16 +2085,36 @@ class TravelPlannerLLM:
                 max_tokens=3000,  # Suficiente para itinerario detallado
                 top_p=0.9,       # Nucleus sampling para calidad
                 frequency_penalty=0.1,  # Evitar repeticiones
-                presence_penalty=0.1    # Promover diversidad
-            )
+                presence_penalty=0.1,   # Promover diversidad
+                stream=stream,
+                timeout=timeout,
+                **({"stream_options": {"include_usage": True}} if stream else {})
+            ), deadline, "generation")
             
-            return response.choices[0].message.content
+            if not stream:
+                record_usage(span, response)
+                return response.choices[0].message.content
             
-        except Exception as e:
-            st.error(f"Error generando itinerario: {str(e)}")
-            return self._generate_fallback_itinerary(preferences, rag_data)
+            # Acumular los fragmentos del streaming (el último trae el uso de tokens)
+            parts = []
+            for chunk in response:
+                if getattr(chunk, "usage", None):
+                    record_usage(span, chunk)
+                if not chunk.choices:
+                    continue
+                if deadline and deadline.remaining() <= 0:
+                    raise DeadlineExceeded("Presupuesto de tiempo agotado durante la generación")
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if not parts:
+                        span.set_attribute("time_to_first_token_ms", round((time.monotonic() - start) * 1000))
+                    parts.append(delta)
+                    on_token(delta)
+            return "".join(parts)
     
-    def _perform_rag_search(self, preferences: TravelPreferences, rag_data: Dict) -> List[str]:
+    def _perform_rag_search(self, preferences: TravelPreferences, rag_data: Dict,
+                            deadline: Optional[Deadline] = None,
+                            rag_mode: str = RAG_DEFAULT_MODE) -> List[str]:
         """Realizar búsqueda RAG semántica"""
         
         # Crear query basada en preferencias
@@ -388,7 +2124,10 @@ class TravelPlannerLLM:
                       f"alojamiento: {preferences.tipo_alojamiento}"
         
         # Búsqueda semántica
-        relevant_info = self.embedding_system.semantic_search(search_query, rag_data)
+        with TRACER.span("rag.search", mode=rag_mode) as span:
+            relevant_info = self.embedding_system.semantic_search(search_query, rag_data, deadline=deadline,
+                                                                  mode=rag_mode)
+            span.set_attribute("result_count", len(relevant_info))
         
         return relevant_info
     
@@ -561,6 +2300,807 @@ class QualityFilter:
         
         return validation_results
 
+# Parámetros del sistema de trabajos en segundo plano
+JOB_MAX_WORKERS = 4          # Generaciones gpt-4o simultáneas por servidor
+JOB_MAX_QUEUE = 12           # Trabajos que pueden esperar turno antes de degradar
+JOB_QUEUE_TIMEOUT = 90.0     # Segundos máximos en cola antes de degradar
+JOB_RESULT_TTL = 30 * 60     # Segundos que se conservan los trabajos terminados
+JOB_REFRESH_INTERVAL = 0.75  # Segundos mínimos entre repintados de un trabajo en curso
+
+# Degradación bajo carga: caché de itinerarios y ruta barata con un modelo menor
+DEGRADED_MODEL = "gpt-4o-mini"
+DEGRADED_MAX_IN_FLIGHT = 4
+DEFAULT_SERVICE_TIME = 25.0  # Estimación de duración de un trabajo sin datos previos
+
+# Modo comparación de destinos
+COMPARE_MAX_DESTINATIONS = 4
+
+class AdmissionController:
+    """Control de admisión con límite global de trabajos en curso y cola FIFO acotada
+    
+    Cada trabajo obtiene un ticket al encolarse; `acquire` espera su turno en
+    orden de llegada. Si la cola está llena, `enqueue` rechaza al momento para
+    que el llamador pueda degradar en lugar de acumular peticiones.
+    """
+    
+    def __init__(self, name: str, max_in_flight: int, max_queue: int,
+                 metrics: Optional[MetricsRegistry] = None):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.metrics = metrics
+        self._in_flight = 0
+        self._waiting: deque = deque()
+        self._service_times: deque = deque(maxlen=50)
+        self._cond = threading.Condition()
+    
+    def _publish(self):
+        if self.metrics:
+            self.metrics.set_gauge(f"admission.{self.name}.in_flight", self._in_flight)
+            self.metrics.set_gauge(f"admission.{self.name}.queue_depth", len(self._waiting))
+    
+    def _count(self, event: str):
+        if self.metrics:
+            self.metrics.incr(f"admission.{self.name}.{event}")
+    
+    def enqueue(self, ticket: str) -> bool:
+        """Reserva un puesto en la cola; False si no queda capacidad"""
+        with self._cond:
+            if len(self._waiting) + self._in_flight >= self.max_in_flight + self.max_queue:
+                self._count("rejected")
+                return False
+            self._waiting.append(ticket)
+            self._publish()
+            return True
+    
+    def acquire(self, ticket: str, timeout: float) -> bool:
+        """Espera el turno del ticket; False si vence el timeout (sigue en la cola)"""
+        with self._cond:
+            admitted = self._cond.wait_for(
+                lambda: self._waiting[0] == ticket and self._in_flight < self.max_in_flight,
+                timeout
+            )
+            if admitted:
+                self._waiting.popleft()
+                self._in_flight += 1
+                self._count("admitted")
+                self._publish()
+                self._cond.notify_all()
+            return admitted
+    
+    def try_acquire(self) -> bool:
+        """Ocupa un puesto sin esperar: solo si hay uno libre y nadie aguarda en la cola"""
+        with self._cond:
+            if self._waiting or self._in_flight >= self.max_in_flight:
+                return False
+            self._in_flight += 1
+            self._count("admitted")
+            self._publish()
+            return True
+    
+    def cancel(self, ticket: str):
+        """Retira un ticket que ya no va a esperar su turno"""
+        with self._cond:
+            if ticket in self._waiting:
+                self._waiting.remove(ticket)
+                self._publish()
+                self._cond.notify_all()
+    
+    def release(self, service_time: float):
+        """Libera un puesto en curso y registra cuánto tardó el trabajo"""
+        with self._cond:
+            self._in_flight -= 1
+            self._service_times.append(service_time)
+            self._publish()
+            self._cond.notify_all()
+    
+    def position(self, ticket: str) -> int:
+        """Posición (1 = siguiente) del ticket en la cola, o 0 si no está esperando"""
+        with self._cond:
+            try:
+                return self._waiting.index(ticket) + 1
+            except ValueError:
+                return 0
+    
+    def estimated_wait(self, position: int) -> float:
+        """Espera estimada en segundos para la posición indicada"""
+        with self._cond:
+            service_time = float(np.mean(self._service_times)) if self._service_times else DEFAULT_SERVICE_TIME
+        return service_time * math.ceil(position / self.max_in_flight)
+
+def itinerary_cache_key(preferences: TravelPreferences, rag_mode: str) -> str:
+    """Clave de caché para preferencias equivalentes"""
+    payload = json.dumps({
+        "destino": canonical_city_key(preferences.destino),
+        "duracion": preferences.duracion,
+        "presupuesto": preferences.presupuesto,
+        "intereses": sorted(preferences.intereses),
+        "tipo_alojamiento": preferences.tipo_alojamiento,
+        "restricciones": preferences.restricciones.strip().lower(),
+        "nivel_aventura": preferences.nivel_aventura,
+        "rag_mode": rag_mode
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def estimate_daily_cost(rag_data: Dict[str, Any], preferences: TravelPreferences) -> tuple:
+    """Coste diario estimado según `presupuesto_diario` y el nivel que permite el presupuesto"""
+    tiers = rag_data.get("presupuesto_diario") or {}
+    per_day = preferences.presupuesto / preferences.duracion
+    tier = "bajo"
+    for name in ("medio", "alto"):
+        if name in tiers and per_day >= tiers[name]:
+            tier = name
+    return tiers.get(tier), tier
+
+def interests_covered(itinerary: str, intereses: List[str]) -> List[str]:
+    """Intereses del viajero que aparecen mencionados en el itinerario"""
+    return [interes for interes in intereses if interes.lower() in itinerary.lower()]
+
+@dataclass
+class ItineraryJob:
+    """Trabajo de generación de itinerario ejecutado fuera del hilo de Streamlit"""
+    job_id: str
+    preferences: TravelPreferences
+    use_rag: bool
+    temperature: float
+    rag_mode: str = RAG_DEFAULT_MODE
+    model: str = "gpt-4o"
+    kind: str = "itinerario"  # itinerario | comparacion
+    destinos: List[str] = field(default_factory=list)
+    comparison: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    skipped_spellings: Dict[str, List[str]] = field(default_factory=dict)  # destino -> grafías duplicadas
+    source: str = "generado"  # generado | caché | degradado | respaldo
+    trace_id: str = ""
+    root_span_id: str = ""
+    render_traced: bool = False  # el span de render se registra una sola vez por trabajo
+    status: str = "en_cola"  # en_cola | ejecutando | completado | rechazado | error
+    stage: str = "⏳ En cola, esperando un worker libre..."
+    progress: int = 0
+    partial: str = ""
+    itinerary: str = ""
+    rag_data: Dict[str, Any] = field(default_factory=dict)
+    validation: Dict[str, Any] = field(default_factory=dict)
+    events: List[str] = field(default_factory=list)
+    error: str = ""
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    version: int = 0
+    _changed: threading.Condition = field(default_factory=threading.Condition, repr=False)
+    
+    @property
+    def done(self) -> bool:
+        return self.status in ("completado", "rechazado", "error")
+    
+    def update(self, event: Optional[str] = None, **changes):
+        """Aplica cambios de estado y despierta a los suscriptores"""
+        with self._changed:
+            for name, value in changes.items():
+                setattr(self, name, value)
+            if event:
+                self.events.append(event)
+            self.version += 1
+            self._changed.notify_all()
+    
+    def claim_render_trace(self) -> bool:
+        """True solo para el primer render del resultado (aunque lo pinten varias sesiones)"""
+        with self._changed:
+            if self.render_traced:
+                return False
+            self.render_traced = True
+            return True
+    
+    def append_partial(self, text: str):
+        """Añade un fragmento del itinerario recibido en streaming"""
+        with self._changed:
+            self.partial += text
+            self.version += 1
+            self._changed.notify_all()
+    
+    def wait_until_done(self, timeout: float) -> bool:
+        """Bloquea hasta que el trabajo termine o venza el timeout; True si terminó"""
+        with self._changed:
+            return self._changed.wait_for(lambda: self.done, timeout)
+
+class JobManager:
+    """Cola de trabajos compartida por todas las sesiones del servidor
+    
+    Los itinerarios se generan en un pool acotado de hilos, de modo que un
+    refresco del navegador o una desconexión no descarta el trabajo y la
+    sesión puede volver a engancharse al mismo `job_id`. Un control de
+    admisión limita las generaciones gpt-4o en curso; cuando la cola se llena
+    se degrada: itinerario en caché, ruta barata con `DEGRADED_MODEL` o
+    rechazo inmediato.
+    """
+    
+    def __init__(self, max_workers: int = JOB_MAX_WORKERS, max_queue: int = JOB_MAX_QUEUE,
+                 result_ttl: float = JOB_RESULT_TTL,
+                 hedger: Optional[HedgedCaller] = None, cache: Optional[TwoTierCache] = None,
+                 metrics: Optional[MetricsRegistry] = None, batcher: Optional[EmbeddingBatcher] = None,
+                 bundle: Optional[KnowledgeBaseBundle] = None):
+        self.result_ttl = result_ttl
+        self.hedger = hedger
+        self.batcher = batcher
+        self.bundle = bundle
+        self.cache = cache or TwoTierCache(InMemoryKVBackend(), metrics=metrics)
+        self.metrics = metrics
+        self.admission = AdmissionController("gpt4o", max_workers, max_queue, metrics)
+        self.degraded_admission = AdmissionController("degraded", DEGRADED_MAX_IN_FLIGHT, 0, metrics)
+        # Un hilo por puesto en curso o en cola: los que esperan bloquean en `acquire`
+        self._executor = ThreadPoolExecutor(max_workers=max_workers + max_queue + DEGRADED_MAX_IN_FLIGHT,
+                                            thread_name_prefix="itinerary-job")
+        self._jobs: Dict[str, ItineraryJob] = {}
+        self._lock = threading.Lock()
+    
+    def submit(self, client, preferences: TravelPreferences, use_rag: bool, temperature: float,
+               rag_mode: str = RAG_DEFAULT_MODE) -> str:
+        """Encola la generación de un itinerario y devuelve su identificador"""
+        job = ItineraryJob(
+            job_id=uuid.uuid4().hex,
+            preferences=preferences,
+            use_rag=use_rag,
+            temperature=temperature,
+            rag_mode=rag_mode
+        )
+        with self._lock:
+            self._purge_expired()
+            self._jobs[job.job_id] = job
+        
+        if self.admission.enqueue(job.job_id):
+            position = self.admission.position(job.job_id)
+            if position:
+                job.update(stage=self._queue_stage(position))
+            self._executor.submit(self._run, job, client)
+        else:
+            self._degrade(job, client, reason="Servidor saturado")
+        return job.job_id
+    
+    def submit_comparison(self, client, preferences: TravelPreferences, destinos: List[str],
+                          use_rag: bool, temperature: float, rag_mode: str = RAG_DEFAULT_MODE) -> str:
+        """Encola la comparación de varios destinos con las mismas preferencias"""
+        # "Donostia" y "San Sebastián" son el mismo destino: se planifica una vez
+        unique = {}
+        skipped = defaultdict(list)
+        for city in destinos:
+            kept = unique.setdefault(canonical_city_key(city), city)
+            if kept is not city:
+                skipped[kept].append(city)
+        job = ItineraryJob(
+            job_id=uuid.uuid4().hex,
+            preferences=preferences,
+            use_rag=use_rag,
+            temperature=temperature,
+            rag_mode=rag_mode,
+            kind="comparacion",
+            destinos=list(unique.values())[:COMPARE_MAX_DESTINATIONS],
+            skipped_spellings=dict(skipped),
+            stage="⏳ Preparando la comparación..."
+        )
+        with self._lock:
+            self._purge_expired()
+            self._jobs[job.job_id] = job
+        
+        # La comparación ocupa un puesto de la cola como cualquier otro trabajo
+        if self.admission.enqueue(job.job_id):
+            position = self.admission.position(job.job_id)
+            if position:
+                job.update(stage=self._queue_stage(position))
+            self._executor.submit(self._run_comparison, job, client)
+        else:
+            self._degrade_comparison(job, reason="Servidor saturado")
+        return job.job_id
+    
+    def get(self, job_id: Optional[str]) -> Optional[ItineraryJob]:
+        """Devuelve el trabajo si existe y no ha caducado"""
+        if not job_id:
+            return None
+        with self._lock:
+            self._purge_expired()
+            return self._jobs.get(job_id)
+    
+    def _purge_expired(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at and now - job.finished_at > self.result_ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+    
+    def _count(self, name: str):
+        if self.metrics:
+            self.metrics.incr(name)
+    
+    def _queue_stage(self, position: int) -> str:
+        wait_s = self.admission.estimated_wait(position)
+        return f"⏳ En cola: posición {position}, espera estimada ~{wait_s:.0f}s"
+    
+    def _degrade(self, job: ItineraryJob, client, reason: str):
+        """Atiende un trabajo sin capacidad gpt-4o: caché, modelo barato o rechazo rápido"""
+        cached = self.cache.get("itinerary", itinerary_cache_key(job.preferences, job.rag_mode),
+                                decode_json)
+        if cached is not None:
+            self._count("degraded.cache")
+            now = time.time()
+            job.update(itinerary=cached["itinerary"], validation=cached["validation"],
+                       rag_data=cached["rag_data"], source="caché", status="completado",
+                       progress=100, started_at=now, finished_at=now,
+                       event=f"♻️ {reason}: itinerario servido desde caché",
+                       stage="🎉 ¡Itinerario listo!")
+            return
+        
+        if self.degraded_admission.enqueue(job.job_id):
+            self._count("degraded.cheap")
+            job.update(model=DEGRADED_MODEL, source="degradado",
+                       event=f"⚡ {reason}: usando la ruta rápida con {DEGRADED_MODEL}")
+            self._executor.submit(self._run, job, client, self.degraded_admission)
+            return
+        
+        self._count("degraded.refused")
+        job.update(status="rechazado", finished_at=time.time(), error=self._refusal(reason),
+                   stage="🚦 Demasiadas solicitudes en este momento")
+    
+    def _refusal(self, reason: str) -> str:
+        wait_s = self.admission.estimated_wait(self.admission.max_queue + 1)
+        return f"{reason}. Inténtalo de nuevo en ~{wait_s:.0f}s."
+    
+    def _degrade_comparison(self, job: ItineraryJob, reason: str):
+        """Comparación sin puesto en la cola: cada destino sale de caché o se rechaza"""
+        now = time.time()
+        for city in job.destinos:
+            job.comparison[city] = self._degrade_city(job, city, None, reason, allow_cheap=False)
+        if any(result["status"] == "completado" for result in job.comparison.values()):
+            job.update(status="completado", progress=100, started_at=now, finished_at=time.time(),
+                       stage="🎉 ¡Comparación completada!")
+        else:
+            job.update(status="rechazado", finished_at=time.time(), error=self._refusal(reason),
+                       stage="🚦 Demasiadas solicitudes en este momento")
+    
+    def _degrade_city(self, job: ItineraryJob, city: str, client, reason: str,
+                      allow_cheap: bool = True) -> Dict[str, Any]:
+        """Destino de una comparación sin capacidad gpt-4o: caché, modelo barato o rechazo"""
+        preferences = replace(job.preferences, destino=city)
+        cached = self.cache.get("itinerary", itinerary_cache_key(preferences, job.rag_mode), decode_json)
+        if cached is not None:
+            self._count("degraded.cache")
+            job.update(event=f"♻️ {city}: {reason}, itinerario servido desde caché")
+            return self._city_summary(preferences, cached["itinerary"], cached["validation"],
+                                      cached["rag_data"], origen="caché")
+        
+        if allow_cheap and self.degraded_admission.try_acquire():
+            self._count("degraded.cheap")
+            job.update(event=f"⚡ {city}: {reason}, usando la ruta rápida con {DEGRADED_MODEL}")
+            return self._generate_city(job, city, client, self.degraded_admission, DEGRADED_MODEL)
+        
+        self._count("degraded.refused")
+        return {"status": "rechazado", "error": self._refusal(reason)}
+    
+    def _run(self, job: ItineraryJob, client, admission: Optional[AdmissionController] = None):
+        """Ejecuta el trabajo en un hilo del pool, dentro de su propia traza"""
+        with TRACER.span("itinerary_job", root=True, job_id=job.job_id, destino=job.preferences.destino,
+                         model=job.model, rag_mode=job.rag_mode) as span:
+            job.update(trace_id=span.trace_id, root_span_id=span.span_id)
+            self._run_pipeline(job, client, admission or self.admission)
+            span.set_attributes(status=job.status, source=job.source)
+    
+    def _await_turn(self, job: ItineraryJob, admission: AdmissionController) -> bool:
+        """Espera el turno del trabajo publicando su posición; False si la espera se alarga demasiado"""
+        with TRACER.span("admission.wait", queue=admission.name,
+                         position=admission.position(job.job_id)) as span:
+            queued_since = time.monotonic()
+            while not admission.acquire(job.job_id, timeout=1.0):
+                if time.monotonic() - queued_since > JOB_QUEUE_TIMEOUT:
+                    admission.cancel(job.job_id)
+                    self._count("admission.queue_timeouts")
+                    span.set_attribute("timed_out", True)
+                    return False
+                job.update(stage=self._queue_stage(admission.position(job.job_id)))
+        return True
+    
+    def _run_pipeline(self, job: ItineraryJob, client, admission: AdmissionController):
+        """Pipeline completo de generación"""
+        if not self._await_turn(job, admission):
+            self._degrade(job, client, reason="Espera en cola demasiado larga")
+            return
+        
+        preferences = job.preferences
+        deadline = Deadline(REQUEST_BUDGET)
+        start = time.monotonic()
+        try:
+            job.update(status="ejecutando", started_at=time.time(), progress=20,
+                       stage="🔍 Recuperando información del destino (RAG)...")
+            notify = lambda message: job.update(event=message)
+            rag_data = get_city_info(preferences.destino, client, deadline=deadline, hedger=self.hedger,
+                                     cache=self.cache, metrics=self.metrics, bundle=self.bundle,
+                                     on_event=notify)
+            generic_info = bool(rag_data.get("informacion_generica"))
+            job.update(rag_data=rag_data, progress=40,
+                       event=f"⚠️ Información genérica para {preferences.destino}" if generic_info
+                       else f"✅ Información completa obtenida para {preferences.destino}")
+            
+            job.update(progress=60, stage=f"🤖 Generando itinerario con OpenAI {job.model}...")
+            llm = TravelPlannerLLM(client, hedger=self.hedger, cache=self.cache,
+                                   metrics=self.metrics, batcher=self.batcher, bundle=self.bundle,
+                                   model=job.model, on_event=notify)
+            itinerary = llm.generate_itinerary(preferences, rag_data, on_token=job.append_partial,
+                                               deadline=deadline, rag_mode=job.rag_mode)
+            if llm.used_fallback:
+                job.update(itinerary=itinerary, progress=90, source="respaldo",
+                           event=f"⚠️ {job.model} no respondió: itinerario básico de respaldo")
+            else:
+                job.update(itinerary=itinerary, progress=90,
+                           event=f"✅ Itinerario generado exitosamente con {job.model}")
+            
+            job.update(stage="✨ Aplicando filtros de calidad...")
+            with TRACER.span("quality_filter") as span:
+                validation = QualityFilter.validate_itinerary(itinerary, preferences)
+                span.set_attribute("score", validation["score"])
+            
+            # Solo se reutilizan bajo carga los itinerarios completos de gpt-4o
+            if not generic_info and job.source == "generado":
+                self.cache.set("itinerary", itinerary_cache_key(preferences, job.rag_mode), encode_json({
+                    "itinerary": itinerary, "validation": validation, "rag_data": rag_data
+                }), decode_json, ttl=ITINERARY_CACHE_TTL)
+            
+            if llm.used_fallback:
+                final_stage = "⚠️ Itinerario básico de respaldo (sin IA)"
+            elif generic_info:
+                final_stage = "⚠️ Itinerario completado con información genérica del destino"
+            else:
+                final_stage = "🎉 ¡Itinerario completado con IA real!"
+            job.update(validation=validation, progress=100, status="completado",
+                       finished_at=time.time(), stage=final_stage)
+        except Exception as e:
+            job.update(status="error", error=str(e), finished_at=time.time(),
+                       stage=f"❌ Error generando itinerario: {str(e)}")
+        finally:
+            admission.release(time.monotonic() - start)
+
+    def _run_comparison(self, job: ItineraryJob, client):
+        """Ejecuta en paralelo el pipeline de cada destino y recoge los resúmenes"""
+        with TRACER.span("comparison_job", root=True, job_id=job.job_id,
+                         destinos=", ".join(job.destinos)) as span:
+            job.update(trace_id=span.trace_id, root_span_id=span.span_id)
+            admitted = self._await_turn(job, self.admission)
+            start = time.monotonic()
+            try:
+                self._compare(job, client, admitted)
+            finally:
+                if admitted:
+                    self.admission.release(time.monotonic() - start)
+    
+    def _compare(self, job: ItineraryJob, client, admitted: bool):
+        job.update(status="ejecutando", started_at=time.time(), progress=5,
+                   stage=f"🆚 Planificando {len(job.destinos)} destinos en paralelo...")
+        try:
+            # El puesto del trabajo lo recorren por turnos los destinos que no encuentran otro libre
+            own_slot = threading.Lock() if admitted else None
+            with ThreadPoolExecutor(max_workers=len(job.destinos),
+                                    thread_name_prefix="compare-city") as executor:
+                futures = {submit_with_context(executor, self._run_city, job, city, client,
+                                               own_slot, index == 0): city
+                           for index, city in enumerate(job.destinos)}
+                for future in as_completed(futures):
+                    city = futures[future]
+                    result = future.result()
+                    job.comparison[city] = result
+                    job.update(progress=5 + int(95 * len(job.comparison) / len(job.destinos)),
+                               event=f"✅ {city}: {result['status']}")
+            job.update(status="completado", finished_at=time.time(),
+                       stage="🎉 ¡Comparación completada!")
+        except Exception as e:
+            job.update(status="error", error=str(e), finished_at=time.time(),
+                       stage=f"❌ Error comparando destinos: {str(e)}")
+    
+    def _run_city(self, job: ItineraryJob, city: str, client, own_slot: Optional[threading.Lock],
+                  first: bool) -> Dict[str, Any]:
+        """Pipeline de un destino de la comparación, bajo el mismo control de admisión"""
+        with TRACER.span("city_pipeline", city=city) as span:
+            result = self._plan_city(job, city, client, own_slot, first)
+            span.set_attribute("status", result["status"])
+            return result
+    
+    def _plan_city(self, job: ItineraryJob, city: str, client, own_slot: Optional[threading.Lock],
+                   first: bool) -> Dict[str, Any]:
+        # El trabajo ya agotó su espera en cola: no se vuelve a la cola destino a destino
+        if own_slot is None:
+            return self._degrade_city(job, city, client, reason="Espera en cola demasiado larga")
+        # Los demás destinos no se ponen a la cola detrás de trabajos posteriores: usan un
+        # puesto libre si lo hay y, si no, esperan su turno en el del propio trabajo
+        if not first and self.admission.try_acquire():
+            return self._generate_city(job, city, client, self.admission, job.model)
+        with own_slot:
+            return self._generate_city(job, city, client, None, job.model)
+    
+    def _generate_city(self, job: ItineraryJob, city: str, client,
+                       admission: Optional[AdmissionController], model: str) -> Dict[str, Any]:
+        """Genera el itinerario de un destino con el puesto ya concedido
+        
+        `admission` es el control cuyo puesto se libera al terminar; None si el
+        destino usa el puesto del propio trabajo de comparación.
+        """
+        preferences = replace(job.preferences, destino=city)
+        deadline = Deadline(REQUEST_BUDGET)
+        start = time.monotonic()
+        try:
+            notify = lambda message: job.update(event=f"{city}: {message}")
+            rag_data = get_city_info(city, client, deadline=deadline, hedger=self.hedger, cache=self.cache,
+                                     metrics=self.metrics, bundle=self.bundle, on_event=notify,
+                                     skipped_spellings=job.skipped_spellings.get(city, []))
+            llm = TravelPlannerLLM(client, hedger=self.hedger, cache=self.cache,
+                                   metrics=self.metrics, batcher=self.batcher, bundle=self.bundle,
+                                   model=model, on_event=notify)
+            itinerary = llm.generate_itinerary(preferences, rag_data, deadline=deadline,
+                                               rag_mode=job.rag_mode)
+            validation = QualityFilter.validate_itinerary(itinerary, preferences)
+            if llm.used_fallback:
+                origen = "respaldo"
+            else:
+                origen = "generado" if model == job.model else "degradado"
+            # Mismo criterio que los itinerarios sueltos: solo se reutilizan los completos de gpt-4o
+            if origen == "generado" and not rag_data.get("informacion_generica"):
+                self.cache.set("itinerary", itinerary_cache_key(preferences, job.rag_mode), encode_json({
+                    "itinerary": itinerary, "validation": validation, "rag_data": rag_data
+                }), decode_json, ttl=ITINERARY_CACHE_TTL)
+            result = self._city_summary(preferences, itinerary, validation, rag_data, origen)
+            result["tiempo_s"] = round(time.monotonic() - start, 2)
+            return result
+        except Exception as e:
+            return {"status": "error", "error": str(e)}
+        finally:
+            if admission:
+                admission.release(time.monotonic() - start)
+    
+    @staticmethod
+    def _city_summary(preferences: TravelPreferences, itinerary: str, validation: Dict,
+                      rag_data: Dict, origen: str) -> Dict[str, Any]:
+        daily_cost, tier = estimate_daily_cost(rag_data, preferences)
+        return {
+            "status": "completado",
+            "origen": origen,
+            "itinerary": itinerary,
+            "validation": validation,
+            "rag_data": rag_data,
+            "costo_diario": daily_cost,
+            "nivel_presupuesto": tier,
+            "intereses_cubiertos": interests_covered(itinerary, preferences.intereses)
+        }
+
+@st.cache_resource
+def get_job_manager() -> JobManager:
+    """Instancia única de la cola de trabajos (sobrevive a los reruns de Streamlit)"""
+    return JobManager(
+        hedger=get_hedger() if HEDGE_IDEMPOTENT_CALLS else None,
+        cache=get_shared_cache(),
+        # Con grabación activa no se agrupan embeddings: el cuerpo de cada petición
+        # dependería del reparto temporal y la reproducción no sería determinista
+        batcher=get_embedding_batcher() if EMBEDDING_BATCHING and CASSETTE_MODE == "off" else None,
+        bundle=get_kb_bundle(),
+        metrics=get_metrics()
+    )
+
+def render_job_progress(job: ItineraryJob):
+    """Muestra el estado de un trabajo de generación (en curso o terminado)"""
+    preferences = job.preferences
+    
+    with st.expander("🔍 Proceso de Generación IA en Tiempo Real", expanded=not job.done):
+        st.progress(job.progress)
+        st.text(job.stage)
+        
+        for event in job.events:
+            if event.startswith("❌"):
+                st.error(event)
+            elif event.startswith("⚠️"):
+                st.warning(event)
+            elif event.startswith("✅") or event.startswith("🎉"):
+                st.success(event)
+            else:
+                st.info(event)
+        
+        # Mostrar parámetros del modelo
+        st.info(f"""
+        **Modelo:** {job.model}  
+        **Temperatura:** {job.temperature}  
+        **RAG Activado:** {'✅' if job.use_rag else '❌'}  
+        **Recuperación:** {RAG_MODES[job.rag_mode]}  
+        **Tokens Máximos:** 3000
+        """)
+        
+        if job.rag_data:
+            # Mostrar preview de la información obtenida
+            with st.expander("📋 Información de la Ciudad Obtenida", expanded=False):
+                st.write(f"**Descripción:** {job.rag_data.get('descripcion', 'N/A')}")
+                st.write(f"**Principales atracciones:** {len(job.rag_data.get('atracciones', []))} encontradas")
+                st.write(f"**Gastronomía:** {len(job.rag_data.get('gastronomia', []))} platos típicos")
+                st.write(f"**Mejor época:** {job.rag_data.get('mejor_epoca', 'N/A')}")
+        
+        if job.validation:
+            if job.validation["is_valid"]:
+                st.success(f"✅ Calidad validada (Score: {job.validation['score']}/100)")
+            else:
+                st.warning(f"⚠️ Calidad mejorable (Score: {job.validation['score']}/100)")
+                if job.validation["issues"]:
+                    st.info("Problemas detectados: " + ", ".join(job.validation["issues"]))
+        
+        if job.status == "error":
+            st.error(job.error)
+        elif job.status == "rechazado":
+            st.warning(f"🚦 {job.error}")
+    
+    # Salida parcial mientras el modelo sigue escribiendo
+    if not job.done and job.partial:
+        st.markdown("---")
+        st.markdown(f"## ✍️ Generando itinerario para {preferences.destino}...")
+        st.markdown(job.partial)
+
+def render_trace(job: ItineraryJob):
+    """Tabla de spans de la traza del trabajo (si fue muestreada)"""
+    st.subheader("🧵 Traza de la Petición")
+    spans = TRACER.get_trace(job.trace_id)
+    if not spans:
+        st.caption(f"Traza no muestreada (TRACE_SAMPLE_RATE={TRACER.sample_rate})")
+        return
+    
+    trace_start = int(spans[0]["startTimeUnixNano"])
+    depth = {}
+    rows = []
+    for span in spans:
+        depth[span["spanId"]] = depth.get(span.get("parentSpanId"), -1) + 1
+        start = int(span["startTimeUnixNano"])
+        rows.append({
+            "span": "  " * depth[span["spanId"]] + span["name"],
+            "inicio_ms": round((start - trace_start) / 1e6, 1),
+            "duracion_ms": round((int(span["endTimeUnixNano"]) - start) / 1e6, 1),
+            "estado": "error" if span["status"]["code"] == 2 else "ok",
+            "atributos": ", ".join(f"{a['key']}={next(iter(a['value'].values()))}"
+                                   for a in span["attributes"])
+        })
+    st.dataframe(rows, use_container_width=True, hide_index=True)
+    st.caption(f"trace_id `{job.trace_id}` · exportada a `{TRACER.path}` (OTLP/JSON)")
+
+def render_itinerary_results(job: ItineraryJob):
+    """Muestra el itinerario terminado con análisis, metadatos, descarga y feedback"""
+    preferences = job.preferences
+    itinerary = job.itinerary
+    validation = job.validation
+    destino = preferences.destino
+    
+    # Mostrar el itinerario generado
+    st.markdown("---")
+    st.markdown("## 📝 Tu Itinerario Personalizado")
+    
+    # Crear tabs para diferentes vistas
+    tab1, tab2, tab3 = st.tabs(["📋 Itinerario Completo", "📊 Análisis", "🔧 Metadatos"])
+    
+    with tab1:
+        st.markdown(itinerary)
+    
+    with tab2:
+        # Métricas del itinerario
+        col_a, col_b, col_c, col_d = st.columns(4)
+        
+        with col_a:
+            st.metric("Palabras", len(itinerary.split()))
+        with col_b:
+            st.metric("Días Cubiertos", preferences.duracion)
+        with col_c:
+            st.metric("Presup./Día", f"€{preferences.presupuesto/preferences.duracion:.0f}")
+        with col_d:
+            st.metric("Score Calidad", f"{validation['score']}/100")
+        
+        # Análisis de contenido
+        st.subheader("📊 Análisis de Contenido")
+        
+        intereses_mencionados = interests_covered(itinerary, preferences.intereses)
+        
+        st.write(f"**Intereses cubiertos:** {', '.join(intereses_mencionados)}")
+        st.write(f"**Mención del destino:** {'✅' if destino.lower() in itinerary.lower() else '❌'}")
+        st.write(f"**Información de presupuesto:** {'✅' if '€' in itinerary else '❌'}")
+    
+    with tab3:
+        # Información técnica
+        st.subheader("🔧 Metadatos Técnicos")
+        
+        metadata = {
+            "timestamp": datetime.fromtimestamp(job.finished_at).isoformat(),
+            "job_id": job.job_id,
+            "modelo_usado": job.model,
+            "origen": job.source,
+            "temperatura": job.temperature,
+            "rag_activado": job.use_rag,
+            "modo_rag": job.rag_mode,
+            "destino": destino,
+            "duracion": preferences.duracion,
+            "presupuesto": preferences.presupuesto,
+            "intereses": preferences.intereses,
+            "score_calidad": validation["score"],
+            "longitud_caracteres": len(itinerary),
+            "longitud_palabras": len(itinerary.split()),
+            "espera_en_cola_s": round(job.started_at - job.created_at, 2),
+            "tiempo_generacion_s": round(job.finished_at - job.started_at, 2),
+            "trace_id": job.trace_id or None
+        }
+        
+        st.json(metadata)
+        render_trace(job)
+    
+    # Botón de descarga
+    st.download_button(
+        label="📥 Descargar Itinerario (Markdown)",
+        data=itinerary,
+        file_name=f"itinerario_{destino.lower()}_{datetime.fromtimestamp(job.finished_at).strftime('%Y%m%d_%H%M')}.md",
+        mime="text/markdown",
+        use_container_width=True
+    )
+    
+    # Feedback del usuario
+    st.markdown("---")
+    st.subheader("💬 Tu Opinión")
+    
+    col_feedback1, col_feedback2 = st.columns(2)
+    
+    with col_feedback1:
+        user_rating = st.slider(
+            "¿Qué tal el itinerario? (1-5 ⭐)",
+            min_value=1,
+            max_value=5,
+            value=4
+        )
+    
+    with col_feedback2:
+        if st.button("📤 Enviar Feedback"):
+            st.success("¡Gracias por tu feedback! Nos ayuda a mejorar la IA.")
+            # En producción: guardar feedback para RLHF
+
+def render_comparison_results(job: ItineraryJob):
+    """Muestra los resúmenes de la comparación lado a lado; los itinerarios se despliegan a demanda"""
+    preferences = job.preferences
+    
+    st.markdown("---")
+    st.markdown("## 🆚 Comparación de Destinos")
+    
+    city_times = [r["tiempo_s"] for r in job.comparison.values() if "tiempo_s" in r]
+    if city_times:
+        st.caption(f"⏱️ Tiempo total: {job.finished_at - job.started_at:.1f}s "
+                   f"(suma secuencial: {sum(city_times):.1f}s)")
+    
+    columns = st.columns(len(job.destinos))
+    for column, city in zip(columns, job.destinos):
+        result = job.comparison.get(city, {})
+        with column:
+            st.subheader(f"📍 {city}")
+            if result.get("status") != "completado":
+                st.warning(f"⚠️ {result.get('error', 'Sin resultado')}")
+                continue
+            
+            if result.get("origen") == "respaldo":
+                st.warning("⚠️ Itinerario básico de respaldo (sin IA)")
+            elif result.get("origen") == "caché":
+                st.info("♻️ Servido desde caché por alta demanda")
+            elif result.get("origen") == "degradado":
+                st.info(f"⚡ Ruta rápida con {DEGRADED_MODEL} por alta demanda")
+            
+            daily_cost = result["costo_diario"]
+            st.metric("Coste estimado/día",
+                      f"€{daily_cost}" if daily_cost is not None else "N/D",
+                      help=f"Nivel de presupuesto: {result['nivel_presupuesto']}")
+            st.metric("Score Calidad", f"{result['validation']['score']}/100")
+            st.metric("Intereses cubiertos",
+                      f"{len(result['intereses_cubiertos'])}/{len(preferences.intereses)}")
+            st.write(", ".join(result["intereses_cubiertos"]) or "—")
+            
+            with st.expander("📋 Ver itinerario completo"):
+                st.markdown(result["itinerary"])
+                st.download_button(
+                    label="📥 Descargar (Markdown)",
+                    data=result["itinerary"],
+                    file_name=f"itinerario_{city.lower()}_{datetime.fromtimestamp(job.finished_at).strftime('%Y%m%d_%H%M')}.md",
+                    mime="text/markdown",
+                    key=f"download_{job.job_id}_{city}",
+                    use_container_width=True
+                )
+    
+    with st.expander("🔧 Metadatos"):
+        render_trace(job)
+
 def main():
     """Función principal de la aplicación"""
     
@@ -607,8 +3147,14 @@ def main():
         if destino_input:
             # Buscar coincidencias en la lista de ciudades españolas
             matches = [city for city in SPANISH_CITIES if destino_input.lower() in city.lower()]
+            canonical = canonical_city(destino_input)
             
-            if destino_input.title() in SPANISH_CITIES:
+            if destino_input.title() not in SPANISH_CITIES and canonical in SPANISH_CITIES:
+                # Variante conocida (cooficial, sin tildes, histórica): se respeta la forma
+                # escrita y el backend la resuelve a la ciudad canónica
+                destino_validated = destino_input.strip()
+                st.success(f"✅ {destino_validated} ({canonical}) - Ciudad encontrada")
+            elif destino_input.title() in SPANISH_CITIES:
                 # Coincidencia exacta
                 destino_validated = destino_input.title()
                 st.success(f"✅ {destino_validated} - Ciudad encontrada")
@@ -626,6 +3172,20 @@ def main():
         # Usar el destino validado
         destino = destino_validated if destino_validated else "Madrid"
         
+        comparar = st.checkbox(
+            "🆚 Comparar varios destinos",
+            help="Planifica varias ciudades a la vez con las mismas preferencias"
+        )
+        destinos_comparar = []
+        if comparar:
+            destinos_comparar = st.multiselect(
+                "Destinos a comparar",
+                SPANISH_CITIES if destino in SPANISH_CITIES else SPANISH_CITIES + [destino],
+                default=[destino],
+                max_selections=COMPARE_MAX_DESTINATIONS,
+                help=f"Hasta {COMPARE_MAX_DESTINATIONS} ciudades"
+            )
+        
         duracion = st.slider(
             "📅 Duración (días)",
             min_value=1,
@@ -683,176 +3243,70 @@ def main():
             use_rag = st.checkbox(
                 "🔍 Usar Búsqueda Semántica (RAG)",
                 value=True,
-                help="Utilizar embeddings para búsqueda contextual"
+                help="Utilizar embeddings para búsqueda contextual. "
+                     "Desactivado: búsqueda léxica BM25 local, sin llamadas a la API"
             )
+            
+            if use_rag:
+                rag_mode = st.selectbox(
+                    "🧭 Modo de Recuperación",
+                    ["hybrid", "embeddings"],
+                    format_func=RAG_MODES.get,
+                    help="Híbrido fusiona embeddings y BM25; solo embeddings usa búsqueda vectorial"
+                )
+            else:
+                rag_mode = "bm25"
     
     # Área principal
     col1, col2 = st.columns([2, 1])
     
     with col1:
-        if st.button("🚀 Generar Itinerario con GPT-4", type="primary", use_container_width=True):
-            # Crear objeto de preferencias
-            preferences = TravelPreferences(
-                destino=destino,
-                duracion=duracion,
-                presupuesto=presupuesto,
-                intereses=intereses,
-                tipo_alojamiento=tipo_alojamiento,
-                restricciones=restricciones,
-                nivel_aventura=nivel_aventura
-            )
-            
-            # Mostrar información del proceso
-            with st.expander("🔍 Proceso de Generación IA en Tiempo Real", expanded=True):
-                progress_bar = st.progress(0)
-                status_text = st.empty()
-                
-                # Paso 1: RAG - Recuperación de información
-                status_text.text("🔍 Recuperando información del destino (RAG)...")
-                progress_bar.progress(20)
-                
-                # Usar el nuevo sistema de información de ciudades
-                rag_data = get_city_info(destino, client)
-                st.success(f"✅ Información completa obtenida para {destino}")
-                
-                # Mostrar preview de la información obtenida
-                with st.expander("📋 Información de la Ciudad Obtenida", expanded=False):
-                    st.write(f"**Descripción:** {rag_data.get('descripcion', 'N/A')}")
-                    st.write(f"**Principales atracciones:** {len(rag_data.get('atracciones', []))} encontradas")
-                    st.write(f"**Gastronomía:** {len(rag_data.get('gastronomia', []))} platos típicos")
-                    st.write(f"**Mejor época:** {rag_data.get('mejor_epoca', 'N/A')}")
-                
-                # Paso 2: Búsqueda semántica (si está habilitada)
-                if use_rag:
-                    status_text.text("🧠 Realizando búsqueda semántica con embeddings...")
-                    progress_bar.progress(40)
-                    time.sleep(1)
-                    st.success("✅ Contexto relevante identificado con IA")
-                
-                # Paso 3: Construcción de prompt avanzado
-                status_text.text("⚙️ Construyendo prompt especializado para GPT-4...")
-                progress_bar.progress(60)
-                time.sleep(1)
-                st.success("✅ Prompt optimizado con técnicas avanzadas")
-                
-                # Paso 4: Generación con GPT-4
-                status_text.text("🤖 Generando itinerario con OpenAI GPT-4...")
-                progress_bar.progress(80)
-                
-                # Mostrar parámetros del modelo
-                with st.container():
-                    st.info(f"""
-                    **Modelo:** GPT-4o  
-                    **Temperatura:** {temperature}  
-                    **RAG Activado:** {'✅' if use_rag else '❌'}  
-                    **Tokens Máximos:** 3000
-                    """)
-                
-                # Generar itinerario
-                llm = TravelPlannerLLM(client)
-                itinerary = llm.generate_itinerary(preferences, rag_data)
-                
-                st.success("✅ Itinerario generado exitosamente con GPT-4")
-                
-                # Paso 5: Control de calidad
-                status_text.text("✨ Aplicando filtros de calidad...")
-                progress_bar.progress(100)
-                time.sleep(0.5)
-                
-                quality_filter = QualityFilter()
-                validation = quality_filter.validate_itinerary(itinerary, preferences)
-                
-                if validation["is_valid"]:
-                    st.success(f"✅ Calidad validada (Score: {validation['score']}/100)")
-                else:
-                    st.warning(f"⚠️ Calidad mejorable (Score: {validation['score']}/100)")
-                    if validation["issues"]:
-                        st.info("Problemas detectados: " + ", ".join(validation["issues"]))
-                
-                status_text.text("🎉 ¡Itinerario completado con IA real!")
-            
-            # Mostrar el itinerario generado
-            st.markdown("---")
-            st.markdown("## 📝 Tu Itinerario Personalizado")
-            
-            # Crear tabs para diferentes vistas
-            tab1, tab2, tab3 = st.tabs(["📋 Itinerario Completo", "📊 Análisis", "🔧 Metadatos"])
-            
-            with tab1:
-                st.markdown(itinerary)
-            
-            with tab2:
-                # Métricas del itinerario
-                col_a, col_b, col_c, col_d = st.columns(4)
-                
-                with col_a:
-                    st.metric("Palabras", len(itinerary.split()))
-                with col_b:
-                    st.metric("Días Cubiertos", preferences.duracion)
-                with col_c:
-                    st.metric("Presup./Día", f"€{preferences.presupuesto/preferences.duracion:.0f}")
-                with col_d:
-                    st.metric("Score Calidad", f"{validation['score']}/100")
-                
-                # Análisis de contenido
-                st.subheader("📊 Análisis de Contenido")
-                
-                intereses_mencionados = []
-                for interes in preferences.intereses:
-                    if interes.lower() in itinerary.lower():
-                        intereses_mencionados.append(interes)
-                
-                st.write(f"**Intereses cubiertos:** {', '.join(intereses_mencionados)}")
-                st.write(f"**Mención del destino:** {'✅' if destino.lower() in itinerary.lower() else '❌'}")
-                st.write(f"**Información de presupuesto:** {'✅' if '€' in itinerary else '❌'}")
-            
-            with tab3:
-                # Información técnica
-                st.subheader("🔧 Metadatos Técnicos")
-                
-                metadata = {
-                    "timestamp": datetime.now().isoformat(),
-                    "modelo_usado": "GPT-4o",
-                    "temperatura": temperature,
-                    "rag_activado": use_rag,
-                    "destino": destino,
-                    "duracion": duracion,
-                    "presupuesto": presupuesto,
-                    "intereses": intereses,
-                    "score_calidad": validation["score"],
-                    "longitud_caracteres": len(itinerary),
-                    "longitud_palabras": len(itinerary.split())
-                }
-                
-                st.json(metadata)
-            
-            # Botón de descarga
-            st.download_button(
-                label="📥 Descargar Itinerario (Markdown)",
-                data=itinerary,
-                file_name=f"itinerario_{destino.lower()}_{datetime.now().strftime('%Y%m%d_%H%M')}.md",
-                mime="text/markdown",
-                use_container_width=True
-            )
-            
-            # Feedback del usuario
-            st.markdown("---")
-            st.subheader("💬 Tu Opinión")
-            
-            col_feedback1, col_feedback2 = st.columns(2)
-            
-            with col_feedback1:
-                user_rating = st.slider(
-                    "¿Qué tal el itinerario? (1-5 ⭐)",
-                    min_value=1,
-                    max_value=5,
-                    value=4
+        job_manager = get_job_manager()
+        
+        # Reengancharse a un trabajo existente (rerun o refresco del navegador)
+        job_id = st.session_state.get("job_id") or st.query_params.get("job")
+        job = job_manager.get(job_id)
+        
+        button_label = "🆚 Comparar Destinos con GPT-4" if comparar else "🚀 Generar Itinerario con GPT-4"
+        if st.button(button_label, type="primary", use_container_width=True):
+            if job and not job.done:
+                st.info("⏳ Ya hay un itinerario generándose para esta sesión. Te mostramos su progreso.")
+            else:
+                # Crear objeto de preferencias
+                preferences = TravelPreferences(
+                    destino=destino,
+                    duracion=duracion,
+                    presupuesto=presupuesto,
+                    intereses=intereses,
+                    tipo_alojamiento=tipo_alojamiento,
+                    restricciones=restricciones,
+                    nivel_aventura=nivel_aventura
                 )
-            
-            with col_feedback2:
-                if st.button("📤 Enviar Feedback"):
-                    st.success("¡Gracias por tu feedback! Nos ayuda a mejorar la IA.")
-                    # En producción: guardar feedback para RLHF
+                if comparar and destinos_comparar:
+                    job_id = job_manager.submit_comparison(client, preferences, destinos_comparar,
+                                                           use_rag=use_rag, temperature=temperature,
+                                                           rag_mode=rag_mode)
+                else:
+                    job_id = job_manager.submit(client, preferences, use_rag=use_rag,
+                                                temperature=temperature, rag_mode=rag_mode)
+                st.session_state["job_id"] = job_id
+                st.query_params["job"] = job_id
+                job = job_manager.get(job_id)
+        
+        if job:
+            render_job_progress(job)
+            if job.status == "completado":
+                # Cada rerun vuelve a pintar el resultado: solo el primero se añade a la traza
+                if job.claim_render_trace():
+                    render_span = TRACER.attach(job.trace_id, job.root_span_id, "streamlit.render",
+                                                kind=job.kind)
+                else:
+                    render_span = nullcontext()
+                with render_span:
+                    if job.kind == "comparacion":
+                        render_comparison_results(job)
+                    else:
+                        render_itinerary_results(job)
     
     with col2:
         # Panel de información técnica
@@ -904,6 +3358,42 @@ def main():
             with metrics_col2:
                 st.metric("Respuesta", "~15-30s")
                 st.metric("Calidad", "95.2%")
+        
+        with st.expander("📈 Métricas de Rendimiento"):
+            metrics = get_metrics()
+            st.write("**Hedging (peticiones duplicadas)**")
+            for key in ("query_embedding", "city_info"):
+                fired = metrics.get(f"hedge.{key}.fired")
+                won = metrics.get(f"hedge.{key}.won")
+                calls = metrics.get(f"hedge.{key}.calls")
+                st.write(f"- `{key}`: {fired:.0f}/{calls:.0f} disparados, "
+                         f"{won:.0f} ganados ({(won / fired * 100) if fired else 0:.0f}%)")
+            st.write("**Control de admisión (gpt-4o)**")
+            st.write(f"- En curso: {metrics.get('admission.gpt4o.in_flight'):.0f}/{JOB_MAX_WORKERS}, "
+                     f"en cola: {metrics.get('admission.gpt4o.queue_depth'):.0f}/{JOB_MAX_QUEUE}")
+            st.write(f"- Rechazados: {metrics.get('admission.gpt4o.rejected'):.0f} "
+                     f"(caché: {metrics.get('degraded.cache'):.0f}, "
+                     f"{DEGRADED_MODEL}: {metrics.get('degraded.cheap'):.0f}, "
+                     f"sin servicio: {metrics.get('degraded.refused'):.0f})")
+            st.write("**Caché de dos niveles**")
+            ratios = get_shared_cache().hit_ratios()
+            for tier, label in (("local", "Local (LRU)"), ("shared", "Compartida")):
+                hits = metrics.get(f"cache.{tier}.hits")
+                total = hits + metrics.get(f"cache.{tier}.misses")
+                st.write(f"- {label}: {ratios[tier] * 100:.0f}% aciertos ({hits:.0f}/{total:.0f})")
+            st.write(f"- Esperas por estampida: {metrics.get('cache.stampede.waits'):.0f}, "
+                     f"errores del backend: {metrics.get('cache.shared.errors'):.0f}")
+            st.write("**Alias de ciudades**")
+            st.write(f"- Variantes resueltas: {metrics.get('city.alias.resolved'):.0f}, "
+                     f"generaciones ahorradas: {metrics.get('city.alias.generations_saved'):.0f} "
+                     f"(generaciones totales: {metrics.get('city.generations'):.0f})")
+            st.write("**Micro-batching de embeddings**")
+            batches = metrics.get("embeddings.batch.requests")
+            callers = metrics.get("embeddings.batch.callers")
+            st.write(f"- {batches:.0f} peticiones para {callers:.0f} llamadas "
+                     f"({(metrics.get('embeddings.batch.inputs') / batches) if batches else 0:.1f} entradas/petición, "
+                     f"espera media {(metrics.get('embeddings.batch.wait_ms') / callers) if callers else 0:.1f} ms)")
+            st.json(metrics.snapshot())
 
     # Footer con información técnica expandida
     st.markdown("---")
@@ -968,6 +3458,16 @@ def main():
         - Sistema de feedback RLHF
         - Multimodalidad (imágenes, mapas)
         """)
+    
+    # Mientras el trabajo siga en curso, repintar a intervalos fijos: el streaming
+    # cambia el trabajo en cada fragmento y un rerun por cambio saturaría el servidor.
+    # Solo el final del trabajo adelanta el repintado
+    if job and not job.done:
+        job.wait_until_done(timeout=JOB_REFRESH_INTERVAL)
+        st.rerun()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if "--build-bundle" in sys.argv:
+        build_bundle_cli(sys.argv)
+    else:
+        main()
\ No newline at end of file